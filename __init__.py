@@ -49,6 +49,7 @@ classes = [
         TMB_PT_true_mb_panel,
         TMB_Warning,
         TMB_Store,
+        TMB_Scaffold,
         TMB_RLayers,
         TMB_Links,
         TMB_SaveBuffers,
@@ -72,10 +73,15 @@ def register():
     bpy.types.Scene.true_mb = PointerProperty(type=TMB_TrueMB)
     bpy.app.handlers.persistent(keyconfig)
     bpy.app.handlers.load_pre.append(keyconfig)
+    for _list, _handler in scene_handlers():
+        _list.append(_handler)
 
 def unregister():
     op = bpy.types.TMB_OT_store
     op.enable = False
+    for _list, _handler in scene_handlers():
+        while _handler in _list:
+            _list.remove(_handler)
     from .tmb_uninstall import TMB_KeyconfigRestore
     register_class(TMB_KeyconfigRestore)
     bpy.ops.tmb.keyconfig_restore()
@@ -0,0 +1,192 @@
+#  True Motion Blur add-on
+#  Render loop per-subframe bookkeeping benchmark
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Doesn't need Blender: nodes are mocked, tmb_model.py doesn't import bpy.
+#  Compares the dicts walk which set Render Layers mute states and File
+#  Outputs paths before every subframe with the compiled render plan
+#  of TMB_Step objects, made and applied by the same tmb_model.py code
+#  as the render operator uses. Scene frame_set and the render itself
+#  are the same for both and aren't measured:
+#
+#  python tests/bench_render_plan.py [scenes] [layers] [passes] [samples]
+
+import os, sys, pathlib, timeit
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from tmb_model import TMB_Pass, TMB_Layer, compile_plan
+
+class Node():
+    '''Render Layers or File Output node, every write is an RNA update'''
+
+    def __init__(self, name):
+        self.name = name
+        self._mute = False
+        self._base_path = ''
+        self.writes = 0
+
+    @property
+    def mute(self):
+        return self._mute
+
+    @mute.setter
+    def mute(self, value):
+        self.writes += 1
+        self._mute = value
+
+    @property
+    def base_path(self):
+        return self._base_path
+
+    @base_path.setter
+    def base_path(self, value):
+        self.writes += 1
+        self._base_path = value
+
+class Socket():
+    def __init__(self, name):
+        self.name = name
+        self.enabled = True
+
+class Scene():
+    def __init__(self, name):
+        self.name = name
+
+def project(scenes, layers, passes, samples):
+    '''
+    Return main storage like RLayers and Scenes dicts: scenes with different
+    shutter, so each one renders its own subframes, File Output per pass
+    '''
+
+    _rlayers = {}
+    _scenes = {}
+    for num in range(scenes):
+        sc = Scene(f'Scene{num}')
+        _scenes[sc] = {'engine' : 'BLENDER_EEVEE', 'tmb' : {'activate' : True}}
+        _shutter = 0.5 + 0.1 * num
+        _subframes = [
+            round(10 - _shutter / 2 + _shutter * i / (samples - 1), 4)
+            for i in range(samples)
+        ]
+        _rlayers[sc] = {'rlayers' : {}, 'subframes' : _subframes}
+        for rl_num in range(layers):
+            rl = Node(f'RL{rl_num}')
+            rl.outputs = [Socket(f'Pass{n}') for n in range(passes)]
+            _rlayers[sc]['rlayers'][rl] = {
+                npass : {
+                    'file_output' : Node(f'FO{n}'),
+                    'path' : os.path.join('tmp', sc.name, rl.name, str(n)),
+                    'image' : None,
+                    'row' : n,
+                } for n, npass in enumerate(rl.outputs)
+            }
+    return _rlayers, _scenes
+
+class DictsWalk():
+    '''set_subframe and set_rlayers before the render plan'''
+
+    def __init__(self, rlayers, scenes):
+        self.rlayers = rlayers
+        self.scenes = scenes
+
+    def step(self, subframe):
+        for sc in list(self.rlayers.keys()):
+            if (
+                self.scenes[sc]['engine'] == 'CYCLES' or
+                not self.scenes[sc]['tmb'] or
+                not self.scenes[sc]['tmb']['activate']
+            ):
+                continue
+            _rlayers = self.rlayers[sc]['rlayers']
+            for rl in list(_rlayers.keys()):
+                for npass in list(_rlayers[rl].keys()):
+                    _fo = _rlayers[rl][npass]['file_output']
+                    _path = _rlayers[rl][npass]['path']
+                    if not _fo:
+                        continue
+                    _fo.base_path = os.path.join(_path, str(subframe), '')
+        self.images = []
+        self.passes = []
+        for sc in list(self.rlayers.keys()):
+            _rlayers = self.rlayers[sc]['rlayers']
+            for rl in list(_rlayers.keys()):
+                _mute = (
+                    len(self.rlayers[sc]['subframes']) == 1 or
+                    not subframe in self.rlayers[sc]['subframes']
+                )
+                rl.mute = _mute
+                for npass in list(_rlayers[rl].keys()):
+                    if _rlayers[rl][npass]['file_output']:
+                        _rlayers[rl][npass]['file_output'].mute = _mute
+                if _mute:
+                    continue
+                _rl_sets = self.rlayers[sc]['rlayers'][rl]
+                for npass in rl.outputs:
+                    if npass.enabled and npass in list(_rl_sets.keys()):
+                        self.images.append(_rl_sets[npass]['image'])
+                        self.passes.append(npass)
+
+class RenderPlan():
+    '''compile_plan once per frame, set_subframe and set_rlayers per step'''
+
+    def __init__(self, rlayers, scenes):
+        _layers = [
+            TMB_Layer(sc, rl, True, None, [
+                TMB_Pass(npass, _sets) for npass, _sets in _rl_sets.items()
+            ])
+            for sc, _sc_sets in rlayers.items()
+            for rl, _rl_sets in _sc_sets['rlayers'].items()
+        ]
+        _weights = {
+            sc : dict.fromkeys(_sets['subframes'], 1)
+            for sc, _sets in rlayers.items()
+        }
+        self.plan = compile_plan(
+            _layers, _weights, sorted(set().union(*_weights.values()))
+        )
+
+    def step(self, subframe):
+        _step = self.plan[subframe]
+        _step.set_paths()
+        _step.set_mute()
+
+def bench(cls, scenes, layers, passes, samples, repeat = 5):
+    '''Return best time per subframe step in seconds and writes per step'''
+
+    _rlayers, _scenes = project(scenes, layers, passes, samples)
+    _subframes = sorted({
+        subfr for _sets in _rlayers.values() for subfr in _sets['subframes']
+    })
+    _loop = cls(_rlayers, _scenes)
+
+    def _frame():
+        for subfr in _subframes:
+            _loop.step(subfr)
+
+    _frame()
+    _nodes = [
+        node for _sets in _rlayers.values()
+        for rl, _passes in _sets['rlayers'].items()
+        for node in [rl] + [_pass['file_output'] for _pass in _passes.values()]
+    ]
+    _before = sum(node.writes for node in _nodes)
+    _frame()
+    _writes = (sum(node.writes for node in _nodes) - _before) / len(_subframes)
+    _best = min(timeit.repeat(_frame, number = 20, repeat = repeat))
+    return _best / 20 / len(_subframes), _writes
+
+def main():
+    _args = [int(arg) for arg in sys.argv[1:]] + [2, 2, 8, 16][len(sys.argv) - 1:]
+    scenes, layers, passes, samples = _args[:4]
+    print(
+        f'{scenes} scenes, {layers} Render Layers per scene,'
+        f' {passes} passes per layer, {samples} samples'
+    )
+    for cls in (DictsWalk, RenderPlan):
+        _time, _writes = bench(cls, scenes, layers, passes, samples)
+        print(
+            f'{cls.__name__:>10}: {_time * 1e6:7.1f} us per subframe,'
+            f' {_writes:5.1f} node writes per subframe'
+        )
+
+if __name__ == '__main__':
+    main()
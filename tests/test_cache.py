@@ -0,0 +1,159 @@
+#  True Motion Blur add-on
+#  Subframes cache keys, files and eviction
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Doesn't need Blender: tmb_cache.py doesn't import bpy.
+#  RNA structs of scene settings are mocked by their bl_rna descriptions
+
+import os, sys, time, pathlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from tmb_cache import TMB_Cache
+
+class Type():
+    def __init__(self, identifier, base = None):
+        self.identifier = identifier
+        self.base = base
+
+ID = Type('ID')
+
+class Prop():
+    def __init__(self, identifier, kind, fixed_type = None, array_length = 0):
+        self.identifier = identifier
+        self.type = kind
+        self.fixed_type = fixed_type
+        self.array_length = array_length
+        self.is_enum_flag = False
+
+class RNA():
+    def __init__(self, properties):
+        self.properties = properties
+
+class Struct():
+    '''RNA struct with properties of kinds guessed from their values'''
+
+    def __init__(self, **values):
+        _props = [Prop('rna_type', 'POINTER', Type('Struct'))]
+        for name, value in values.items():
+            if isinstance(value, Struct):
+                _props.append(Prop(name, 'POINTER', Type('Struct')))
+            elif isinstance(value, DataBlock):
+                _props.append(Prop(name, 'POINTER', Type('Object', ID)))
+            elif isinstance(value, tuple):
+                _props.append(Prop(name, 'FLOAT', array_length = len(value)))
+            elif isinstance(value, bool):
+                _props.append(Prop(name, 'BOOLEAN'))
+            elif isinstance(value, str):
+                _props.append(Prop(name, 'ENUM'))
+            else:
+                _props.append(Prop(name, 'FLOAT'))
+        self.bl_rna = RNA(_props)
+        for name, value in values.items():
+            setattr(self, name, value)
+
+class DataBlock():
+    def __init__(self, name):
+        self.name = name
+
+def display():
+    '''Scene display settings of a Workbench render'''
+
+    return Struct(
+        render_aa = '8',
+        shading = Struct(
+            light = 'STUDIO', color_type = 'MATERIAL',
+            show_cavity = False, cavity_ridge_factor = 1.0,
+            single_color = (0.8, 0.8, 0.8),
+        ),
+    )
+
+def scene_key(*structs):
+    return TMB_Cache.key('token', 0, 'Scene', [
+        TMB_Cache.rna_values(_struct) for _struct in structs
+    ])
+
+def test_key():
+    assert TMB_Cache.key('a', [1, 0.5], ('x',)) == TMB_Cache.key(
+        'a', (1, 0.5), ['x']
+    )
+    assert TMB_Cache.key('a', 1) != TMB_Cache.key('a', 2)
+    assert TMB_Cache.key('a', 1) != TMB_Cache.key('a', '1', 2)
+
+def test_key_owned_structs():
+    '''Workbench shading changes are in the key, data-blocks are not'''
+
+    _display = display()
+    _key = scene_key(_display)
+    for name, value in (
+        ('light', 'FLAT'), ('color_type', 'OBJECT'), ('show_cavity', True),
+        ('cavity_ridge_factor', 2.0), ('single_color', (1.0, 0.0, 0.0)),
+    ):
+        _changed = display()
+        setattr(_changed.shading, name, value)
+        assert scene_key(_changed) != _key, name
+    _display.camera = DataBlock('Camera')
+    _display.bl_rna.properties.append(
+        Prop('camera', 'POINTER', Type('Object', ID))
+    )
+    assert scene_key(_display) == _key
+
+def test_key_stable_across_render():
+    '''
+    A TMB render sets frames, mutes nodes and restores them: the scene
+    settings it hashes make the same key when the next render starts
+    '''
+
+    _display = display()
+    _before = scene_key(_display)
+    _shading = _display.shading
+    _shading.light, _shading.show_cavity = 'FLAT', True
+    _shading.light, _shading.show_cavity = 'STUDIO', False
+    assert scene_key(_display) == _before
+    assert scene_key(display()) == _before
+
+def files(folder, names, size = 10):
+    folder.mkdir(exist_ok = True)
+    _files = []
+    for name in names:
+        _file = folder / name
+        _file.write_bytes(b'x' * size)
+        _files.append(str(_file))
+    return _files
+
+def test_add_link_and_get(tmp_path):
+    _cache = TMB_Cache(str(tmp_path / 'cache'), 1 << 20)
+    assert _cache.get('key') is None
+    _files = files(tmp_path / 'sub', ['R.exr', 'G.exr'])
+    _cache.add('key', _files)
+    _folder = _cache.get('key')
+    assert sorted(os.listdir(_folder)) == ['G.exr', 'R.exr']
+    assert all(os.path.isfile(_file) for _file in _files) #---- still there
+    assert not [
+        name for name in os.listdir(_cache.path) if name.endswith('.tmp')
+    ]
+
+def test_add_move(tmp_path):
+    _cache = TMB_Cache(str(tmp_path / 'cache'), 1 << 20)
+    _files = files(tmp_path / 'capture', ['Image.npy'])
+    _cache.add('key', _files, move = True)
+    assert not os.path.exists(_files[0])
+    assert os.listdir(_cache.get('key')) == ['Image.npy']
+    #------------------ already cached: files to move are removed anyway
+    _again = files(tmp_path / 'capture', ['Image.npy'], 20)
+    _cache.add('key', _again, move = True)
+    assert not os.path.exists(_again[0])
+    _cached = os.path.join(_cache.get('key'), 'Image.npy')
+    assert os.path.getsize(_cached) == 10 #------------------ not replaced
+
+def test_evict(tmp_path):
+    _cache = TMB_Cache(str(tmp_path / 'cache'), 25)
+    for num, key in enumerate(('old', 'used', 'new')):
+        _cache.add(key, files(tmp_path / key, ['R.exr']))
+        _time = time.time() - 100 + num
+        os.utime(_cache.folder(key), (_time, _time))
+    _cache.get('old') #------------------------ used last, kept by eviction
+    _stale = tmp_path / 'cache' / 'key.123.tmp'
+    _stale.mkdir()
+    os.utime(_stale, (0, 0))
+    _cache.evict()
+    assert sorted(os.listdir(_cache.path)) == ['new', 'old']
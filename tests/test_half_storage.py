@@ -0,0 +1,156 @@
+#  True Motion Blur add-on
+#  Half float subframes storage error bound
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Doesn't need Blender: tmb_buffers.py doesn't import bpy.
+#  Synthetic HDR subframes are stored as float16 by every storage backend
+#  and as ZIP compressed HALF EXR files like the compositor writes them,
+#  summed by the threads pool like rendered subframes and compared
+#  with the float64 mean of the original float32 values
+
+import os, sys, zlib, struct, pathlib
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from tmb_buffers import STORAGE, EXR_MAGIC, TMB_EXR, TMB_Pool
+
+SUBFRAMES = 32
+WIDTH = 64
+HEIGHT = 48
+
+def hdr_subframes(seed = 0):
+    '''
+    Return (subframes, height, width, 3) float32 RGB values over the whole
+    half float range: signs of data passes, values near zero and up to 6e4
+    '''
+
+    _rng = np.random.default_rng(seed)
+    _shape = (SUBFRAMES, HEIGHT, WIDTH, 3)
+    _values = np.exp(_rng.uniform(np.log(1e-4), np.log(6e4), _shape))
+    _values *= _rng.choice([-1.0, 1.0], _shape)
+    _values[:, :4] = _rng.uniform(-1e-6, 1e-6, (SUBFRAMES, 4, WIDTH, 3))
+    return _values.astype('f')
+
+def exr_write_zip(path, channels):
+    '''
+    Write dict {channel name : (height, width) float16 array, top to bottom}
+    to ZIP compressed HALF scanline EXR file as OpenEXR does: blocks of 16
+    lines, bytes split to even and odd halves, delta predictor, zlib
+    '''
+
+    _exr = TMB_EXR()
+    _names = sorted(channels.keys())
+    _h, _w = channels[_names[0]].shape
+    _chlist = b''.join(
+        name.encode() + b'\0' + struct.pack('<iB3xii', 1, 0, 1, 1)
+        for name in _names
+    ) + b'\0'
+    _box = struct.pack('<iiii', 0, 0, _w - 1, _h - 1)
+    _one = struct.pack('<f', 1)
+    _header = struct.pack('<ii', EXR_MAGIC, 2) + b''.join((
+        _exr.exr_attribute('channels', 'chlist', _chlist),
+        _exr.exr_attribute('compression', 'compression', b'\3'),
+        _exr.exr_attribute('dataWindow', 'box2i', _box),
+        _exr.exr_attribute('displayWindow', 'box2i', _box),
+        _exr.exr_attribute('lineOrder', 'lineOrder', b'\0'),
+        _exr.exr_attribute('pixelAspectRatio', 'float', _one),
+        _exr.exr_attribute('screenWindowCenter', 'v2f', bytes(8)),
+        _exr.exr_attribute('screenWindowWidth', 'float', _one),
+    )) + b'\0'
+    _chunks = []
+    for _y in range(0, _h, 16):
+        _raw = np.frombuffer(b''.join(
+            channels[name][line].astype('<f2').tobytes()
+            for line in range(_y, min(_y + 16, _h)) for name in _names
+        ), dtype=np.uint8)
+        _split = np.concatenate((_raw[0::2], _raw[1::2]))
+        _delta = _split.copy()
+        _delta[1:] = np.diff(_split) + np.uint8(128)
+        _data = zlib.compress(_delta.tobytes())
+        if len(_data) >= _raw.size:
+            _data = _raw.tobytes()
+        _chunks.append(struct.pack('<ii', _y, len(_data)) + _data)
+    _offsets = len(_header) + 8 * len(_chunks) + np.cumsum(
+        [0] + [len(chunk) for chunk in _chunks[:-1]], dtype='<u8'
+    )
+    with open(path, 'wb') as fh:
+        fh.write(_header)
+        fh.write(_offsets.astype('<u8').tobytes())
+        fh.write(b''.join(_chunks))
+
+def mix_files(subframes, save):
+    '''
+    Sum files saved by save(number, RGB (height, width, 3) array) with
+    the threads pool and return their average in Blender pixels order
+    '''
+
+    _pool = TMB_Pool()
+    _pool.pool_start(4)
+    _sums = np.zeros((1, HEIGHT * WIDTH * 4), dtype='f')
+    try:
+        for num, _rgb in enumerate(subframes):
+            _pool.pool_add(save(num, _rgb), [('sums', _sums, [0], [''])])
+        _pool.pool_wait()
+        _pool.pool_divide([_sums], [np.array([SUBFRAMES])])
+    finally:
+        _pool.pool_stop()
+    return _sums
+
+def check_error_bound(subframes, sums):
+    '''Assert that mixed half float subframes are within the bound'''
+
+    #---------------- Blender pixels order: RGBA rows from bottom to top
+    _mixed = sums.reshape(HEIGHT, WIDTH, 4)[::-1, :, :3]
+    _mean = subframes.astype(np.float64).mean(axis = 0)
+    _mean_abs = np.abs(subframes.astype(np.float64)).mean(axis = 0)
+    _bound = (2**-11 + SUBFRAMES * 2**-24) * _mean_abs + 2**-25
+    _error = np.abs(_mixed - _mean)
+    assert (_error <= _bound).all(), (
+        f'max error / bound {(_error / _bound).max():.3f}'
+    )
+    #------------------------------- the bound isn't loose by orders either
+    assert (_error / _bound).max() > 0.01
+
+@pytest.mark.parametrize('storage', sorted(STORAGE))
+def test_half_mix_error_bound(tmp_path, storage):
+    _subframes = hdr_subframes()
+    _pool = TMB_Pool()
+
+    def _save(num, rgb):
+        return _pool.storage_save(
+            str(tmp_path / f'{num:04d}'),
+            {'R' : rgb[..., 0], 'G' : rgb[..., 1], 'B' : rgb[..., 2]},
+            storage,
+            half = True
+        )
+
+    _sums = mix_files(_subframes, _save)
+    assert not os.listdir(tmp_path) #------------- files deleted after mixing
+    check_error_bound(_subframes, _sums)
+
+def test_half_compositor_exr(tmp_path):
+    '''Compositor File Output subframes: RGBA half float, ZIP codec'''
+
+    _subframes = hdr_subframes(1)
+
+    def _save(num, rgb):
+        _path = str(tmp_path / f'{num:04d}.exr')
+        _half = rgb.astype(np.float16)
+        exr_write_zip(_path, {
+            'R' : _half[..., 0], 'G' : _half[..., 1], 'B' : _half[..., 2],
+            'A' : np.ones((HEIGHT, WIDTH), dtype=np.float16),
+        })
+        return _path
+
+    #---------------------------- the reader decodes what OpenEXR encodes:
+    _path = _save(0, _subframes[0])
+    header, channels = TMB_EXR().exr_channels(_path)
+    assert header['compression'] == 'ZIP'
+    assert os.path.getsize(_path) < HEIGHT * WIDTH * 4 * 2 #----- zlib blocks
+    assert channels['R'].dtype == np.float16
+    assert np.array_equal(channels['G'], _subframes[0][..., 1].astype('f2'))
+    os.remove(_path)
+    _sums = mix_files(_subframes, _save)
+    assert not os.listdir(tmp_path)
+    check_error_bound(_subframes, _sums)
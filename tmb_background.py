@@ -0,0 +1,118 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+#  True Motion Blur add-on
+#  TMB background render
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Headless entry point for render farms:
+#
+#  blender -b file.blend --python-exit-code 1 \
+#      --python path/to/true_motion_blur/tmb_background.py \
+#      -- -s 1 -e 250 -o //render/shot_
+#
+#  Options after "--" follow Blender's own command line ones:
+#  -S scene, -s start frame, -e end frame, -j frame step, -f single frame,
+#  -o output path. Settings not given are taken from the scene.
+#  --claim renders only frames claimed through lock files (see tmb_farm.py),
+#  --run is the id of renders sharing frames, their frames done markers
+#  are ignored by other runs,
+#  --tempdir sets temporary directory for subframes.
+#  The add-on is enabled for this Blender session if it isn't already.
+
+import bpy, sys, pathlib, argparse, addon_utils
+
+def render_background(
+    scene = None, start = None, end = None, step = None, output = None,
+    claim = False, tempdir = None, run = ''
+):
+    '''
+    Render TMB animation of the scene synchronously, without window or UI.
+    Frame range and output path override the scene settings.
+    If claim is True render only frames claimed through lock files
+    shared with other renders of the run.
+    Return render operator result
+    '''
+
+    if not bpy.app.background:
+        raise RuntimeError('TMB background render needs blender -b')
+    sc = bpy.data.scenes[scene] if scene else bpy.context.scene
+    if start is not None:
+        sc.frame_start = start
+    if end is not None:
+        sc.frame_end = end
+    if step is not None:
+        sc.frame_step = step
+    if output is not None:
+        sc.render.filepath = output
+    if tempdir is not None:
+        pathlib.Path(tempdir).mkdir(parents = True, exist_ok = True)
+        bpy.context.preferences.filepaths.temporary_directory = tempdir
+    return bpy.ops.tmb_render.render(
+        {'scene' : sc}, animation = True, claim = claim, run = run
+    )
+
+def addon_enable():
+    '''Enable the add-on this file belongs to, if it is not registered'''
+
+    if hasattr(bpy.types, 'TMB_RENDER_OT_render'):
+        return
+    _name = pathlib.Path(__file__).resolve().parent.name
+    if not addon_utils.enable(_name, default_set = False):
+        raise RuntimeError(f'Can\'t enable True Motion Blur add-on "{_name}"')
+
+def main():
+    _argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    _parser = argparse.ArgumentParser(
+        prog = 'blender -b file.blend --python tmb_background.py --',
+        description = 'True Motion Blur background render'
+    )
+    _parser.add_argument('-S', '--scene', help = 'scene name')
+    _parser.add_argument('-s', '--frame-start', type = int)
+    _parser.add_argument('-e', '--frame-end', type = int)
+    _parser.add_argument('-j', '--frame-jump', type = int, help = 'frame step')
+    _parser.add_argument('-f', '--frame', type = int, help = 'single frame')
+    _parser.add_argument('-o', '--output', help = 'render output path')
+    _parser.add_argument(
+        '--claim', action = 'store_true',
+        help = 'render only frames claimed through lock files'
+    )
+    _parser.add_argument(
+        '--run', default = '',
+        help = 'id of the renders sharing claimed frames'
+    )
+    _parser.add_argument('--tempdir', help = 'temporary directory')
+    args = _parser.parse_args(_argv)
+    if args.frame is not None:
+        args.frame_start = args.frame_end = args.frame
+    addon_enable()
+    _result = render_background(
+        scene = args.scene,
+        start = args.frame_start,
+        end = args.frame_end,
+        step = args.frame_jump,
+        output = args.output,
+        claim = args.claim,
+        run = args.run,
+        tempdir = args.tempdir
+    )
+    if 'FINISHED' not in _result:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
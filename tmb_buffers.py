@@ -0,0 +1,618 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+#  True Motion Blur add-on
+#  TMB pixel buffers
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Module doesn't import bpy: Blender images are only passed in as arguments
+
+import os, struct, zlib, threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+#------------------------------- Bulk Pixels I/O -------------------------------
+
+class TMB_Pixels():
+    '''
+    Bulk pixels transfer between Blender images and float32 ndarrays.
+    Uses foreach_get/foreach_set, so no Python lists are built on the way
+    '''
+
+    buffers = {}
+
+    def pixels_len(self, img):
+        '''Return number of float values in Blender image pixels'''
+
+        return img.size[0] * img.size[1] * img.channels
+
+    def pixels_buffer(self, length, name = 'io'):
+        '''Return reusable float32 ndarray of length stored under name'''
+
+        _buffers = TMB_Pixels.buffers
+        _key = (name, length)
+        if _key not in _buffers:
+            _buffers[_key] = np.empty(length, dtype='f')
+        return _buffers[_key]
+
+    def pixels_clear(self):
+        '''Release all reusable buffers'''
+
+        TMB_Pixels.buffers.clear()
+
+    def pixels_read(self, img, out = None):
+        '''
+        Read Blender image pixels into out array
+        or into the reusable "io" buffer. Return the array
+        '''
+
+        if out is None:
+            out = self.pixels_buffer(self.pixels_len(img))
+        img.pixels.foreach_get(out)
+        return out
+
+    def pixels_write(self, img, array):
+        '''Write float32 ndarray to Blender image pixels'''
+
+        if array.dtype != np.float32 or not array.flags['C_CONTIGUOUS']:
+            array = np.ascontiguousarray(array, dtype='f')
+        img.pixels.foreach_set(array)
+
+    def pixels_fill(self, img, value):
+        '''Fill Blender image pixels with constant value'''
+
+        _buffers = TMB_Pixels.buffers
+        _key = ('fill', value, self.pixels_len(img))
+        if _key not in _buffers:
+            _buffers[_key] = np.full(_key[2], value, dtype='f')
+        img.pixels.foreach_set(_buffers[_key])
+
+#------------------------------- OpenEXR Reader --------------------------------
+
+EXR_MAGIC = 20000630
+EXR_TILED = 0x200
+EXR_DEEP = 0x800
+EXR_MULTIPART = 0x1000
+EXR_COMPRESSION = (
+    'NONE', 'RLE', 'ZIPS', 'ZIP', 'PIZ', 'PXR24', 'B44', 'B44A', 'DWAA', 'DWAB'
+)
+EXR_LINES = {'NONE' : 1, 'RLE' : 1, 'ZIPS' : 1, 'ZIP' : 16}
+EXR_TYPES = {0 : '<u4', 1 : '<f2', 2 : '<f4'}
+
+class TMB_EXR():
+    '''
+    Numpy reader for the single part scanline OpenEXR files written
+    by TMB File Outputs. Supports NONE, RLE, ZIPS and ZIP compression.
+    Uncompressed files are memory-mapped, not read
+    '''
+
+    def exr_attributes(self, data):
+        '''
+        Parse EXR header from the beginning of data bytes.
+        Return dict of raw attributes and the header size
+        '''
+
+        _magic, _version = struct.unpack_from('<ii', data, 0)
+        if _magic != EXR_MAGIC:
+            raise ValueError('Not an OpenEXR file')
+        if _version & (EXR_TILED | EXR_DEEP | EXR_MULTIPART):
+            raise ValueError('Only single part scanline OpenEXR is supported')
+        _attrs = {}
+        pos = 8
+        while data[pos] != 0:
+            _end = data.index(b'\0', pos)
+            _name = bytes(data[pos:_end]).decode()
+            pos = _end + 1
+            _end = data.index(b'\0', pos)
+            pos = _end + 1
+            _size = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+            _attrs[_name] = bytes(data[pos:pos+_size])
+            pos += _size
+        return _attrs, pos + 1
+
+    def exr_channel_list(self, chlist):
+        '''Return list of (channel name, numpy dtype) from "chlist" value'''
+
+        _channels = []
+        pos = 0
+        while chlist[pos] != 0:
+            _end = chlist.index(b'\0', pos)
+            _name = chlist[pos:_end].decode()
+            _type, _, _xs, _ys = struct.unpack_from('<iiii', chlist, _end + 1)
+            if _xs != 1 or _ys != 1:
+                raise ValueError('Subsampled EXR channels are not supported')
+            _channels.append((_name, EXR_TYPES[_type]))
+            pos = _end + 17
+        return _channels
+
+    def exr_header(self, fh):
+        '''
+        Read EXR header and line offsets table from open binary file.
+        Return dict with "channels", "compression", "width", "height"
+        and "offsets"
+        '''
+
+        _size = 1 << 16
+        while True:
+            fh.seek(0)
+            data = fh.read(_size)
+            try:
+                _attrs, pos = self.exr_attributes(data)
+                break
+            except (IndexError, ValueError, struct.error):
+                if len(data) < _size:
+                    raise
+                _size <<= 2
+        _xmin, _ymin, _xmax, _ymax = struct.unpack('<iiii', _attrs['dataWindow'])
+        header = {
+            "channels" : sorted(self.exr_channel_list(_attrs['channels'])),
+            "compression" : EXR_COMPRESSION[_attrs['compression'][0]],
+            "width" : _xmax - _xmin + 1,
+            "height" : _ymax - _ymin + 1,
+            "ymin" : _ymin,
+        }
+        if header['compression'] not in EXR_LINES:
+            raise ValueError(
+                f'Unsupported EXR compression: {header["compression"]}'
+            )
+        _lines = EXR_LINES[header['compression']]
+        _blocks = -(-header['height'] // _lines)
+        fh.seek(pos)
+        header["offsets"] = np.frombuffer(fh.read(8 * _blocks), dtype='<u8')
+        header["lines"] = _lines
+        return header
+
+    def exr_line_dtype(self, header):
+        '''Return structured dtype of one scanline of all channels'''
+
+        _w = header['width']
+        return np.dtype([
+            (f'c{num}', dt, (_w,))
+            for num, (name, dt) in enumerate(header['channels'])
+        ])
+
+    def exr_unzip(self, data, size):
+        '''Undo EXR ZIP/RLE predictor and bytes interleaving'''
+
+        _raw = np.frombuffer(data, dtype=np.uint8)[:size]
+        _delta = _raw ^ np.uint8(128)
+        _delta[:1] = _raw[:1]
+        _t = np.cumsum(_delta, dtype=np.uint8)
+        _half = (size + 1) // 2
+        _out = np.empty(size, dtype=np.uint8)
+        _out[0::2] = _t[:_half]
+        _out[1::2] = _t[_half:]
+        return _out
+
+    def exr_unrle(self, data, size):
+        '''Expand EXR RLE runs'''
+
+        _out = bytearray()
+        pos = 0
+        while pos < len(data) and len(_out) < size:
+            _count = struct.unpack_from('b', data, pos)[0]
+            pos += 1
+            if _count < 0:
+                _out += data[pos:pos-_count]
+                pos -= _count
+            else:
+                _out += data[pos:pos+1] * (_count + 1)
+                pos += 1
+        return bytes(_out)
+
+    def exr_channels(self, path):
+        '''
+        Return EXR header and dict {channel name : (height, width) array}.
+        Arrays of uncompressed files are views of the memory-mapped file
+        '''
+
+        with open(path, 'rb') as fh:
+            header = self.exr_header(fh)
+            _names = [name for name, dt in header['channels']]
+            _line = self.exr_line_dtype(header)
+            _h = header['height']
+            _offsets = header['offsets']
+            _stride = 8 + _line.itemsize
+            if (
+                header['compression'] == 'NONE' and
+                _h and
+                np.all(np.diff(_offsets.astype(np.int64)) == _stride)
+            ):
+                _chunk = np.dtype([
+                    ('y', '<i4'), ('size', '<i4'), ('data', _line)
+                ])
+                _map = np.memmap(
+                    path, dtype=_chunk, mode='r',
+                    offset=int(_offsets[0]), shape=(_h,)
+                )
+                _data = _map['data']
+                return header, {
+                    name : _data[f'c{num}'] for num, name in enumerate(_names)
+                }
+            _lines = header['lines']
+            _block = np.empty(_h, dtype=_line)
+            for _offset in _offsets:
+                fh.seek(int(_offset))
+                _y, _size = struct.unpack('<ii', fh.read(8))
+                _first = _y - header['ymin']
+                _count = min(_lines, _h - _first)
+                _raw_size = _count * _line.itemsize
+                data = fh.read(_size)
+                if _size < _raw_size:
+                    if header['compression'] == 'RLE':
+                        data = self.exr_unzip(
+                            self.exr_unrle(data, _raw_size), _raw_size
+                        )
+                    else:
+                        data = self.exr_unzip(
+                            zlib.decompress(data), _raw_size
+                        )
+                _block[_first:_first+_count] = np.frombuffer(
+                    data, dtype=_line, count=_count
+                )
+            return header, {
+                name : _block[f'c{num}'] for num, name in enumerate(_names)
+            }
+
+    def exr_layer(self, channels, layer = ''):
+        '''
+        Return list of 4 channel arrays (or None) for RGBA of the layer.
+        Single channel layers are repeated to RGB. Alpha is always None:
+        subframes are saved as RGB, so multilayer files are mixed the same way
+        '''
+
+        _prefix = f'{layer}.' if layer else ''
+        _suffixes = {
+            name[len(_prefix):] : arr for name, arr in channels.items()
+            if name.startswith(_prefix) and '.' not in name[len(_prefix):]
+        }
+        if not _suffixes:
+            raise KeyError(f'No "{layer}" layer channels in EXR file')
+        if len(_suffixes) == 1:
+            _single = list(_suffixes.values())[0]
+            return [_single, _single, _single, None]
+        _rgba = []
+        for names in (('R', 'X'), ('G', 'Y'), ('B', 'Z')):
+            _found = [_suffixes[nm] for nm in names if nm in _suffixes]
+            _rgba.append(_found[0] if _found else None)
+        return _rgba + [None]
+
+    def exr_to_pixels(self, path, out, layer = '', add = False):
+        '''
+        Write (or add if add is True) EXR layer pixels to out float32 array
+        in Blender pixels order: RGBA, bottom to top
+        '''
+
+        header, channels = self.exr_channels(path)
+        return self.exr_layer_to_pixels(header, channels, out, layer, add)
+
+    def exr_layer_to_pixels(self, header, channels, out, layer, add):
+        '''exr_to_pixels for already opened EXR channels'''
+
+        _w = header['width']
+        _h = header['height']
+        if out.size != _w * _h * 4:
+            raise ValueError(
+                f'EXR size {_w}x{_h} doesn\'t match buffer length {out.size}'
+            )
+        _out = out.reshape(_h, _w, 4)[::-1]
+        for num, arr in enumerate(self.exr_layer(channels, layer)):
+            if arr is None:
+                if add:
+                    _out[..., num] += 1.0
+                else:
+                    _out[..., num] = 1.0
+            elif add:
+                _out[..., num] += arr
+            else:
+                _out[..., num] = arr
+        return out
+
+    def exr_attribute(self, name, kind, value):
+        '''Return bytes of one EXR header attribute'''
+
+        return (
+            name.encode() + b'\0' + kind.encode() + b'\0' +
+            struct.pack('<i', len(value)) + value
+        )
+
+    def exr_write(self, path, channels):
+        '''
+        Write dict {channel name : (height, width) float array, top to bottom}
+        to uncompressed single part scanline EXR file.
+        float16 arrays are saved as HALF channels, all others as FLOAT
+        '''
+
+        _names = sorted(channels.keys())
+        _h, _w = channels[_names[0]].shape
+        _types = {
+            name : (1, '<f2') if channels[name].dtype == np.float16
+            else (2, '<f4') for name in _names
+        }
+        _chlist = b''.join(
+            name.encode() + b'\0' +
+            struct.pack('<iB3xii', _types[name][0], 0, 1, 1)
+            for name in _names
+        ) + b'\0'
+        _box = struct.pack('<iiii', 0, 0, _w - 1, _h - 1)
+        _one = struct.pack('<f', 1)
+        _header = struct.pack('<ii', EXR_MAGIC, 2) + b''.join((
+            self.exr_attribute('channels', 'chlist', _chlist),
+            self.exr_attribute('compression', 'compression', b'\0'),
+            self.exr_attribute('dataWindow', 'box2i', _box),
+            self.exr_attribute('displayWindow', 'box2i', _box),
+            self.exr_attribute('lineOrder', 'lineOrder', b'\0'),
+            self.exr_attribute('pixelAspectRatio', 'float', _one),
+            self.exr_attribute('screenWindowCenter', 'v2f', bytes(8)),
+            self.exr_attribute('screenWindowWidth', 'float', _one),
+        )) + b'\0'
+        _line = np.dtype([
+            (f'c{num}', _types[name][1], (_w,))
+            for num, name in enumerate(_names)
+        ])
+        _chunk = np.dtype([('y', '<i4'), ('size', '<i4'), ('data', _line)])
+        _chunks = np.empty(_h, dtype=_chunk)
+        _chunks['y'] = np.arange(_h)
+        _chunks['size'] = _line.itemsize
+        for num, name in enumerate(_names):
+            _chunks['data'][f'c{num}'] = channels[name]
+        _start = len(_header) + 8 * _h
+        _offsets = _start + np.arange(_h, dtype='<u8') * _chunk.itemsize
+        with open(path, 'wb') as fh:
+            fh.write(_header)
+            fh.write(_offsets.tobytes())
+            fh.write(_chunks.tobytes())
+
+#------------------------------ Subframes Storage ------------------------------
+
+#  Compositor File Outputs can only write images, so subframes rendered
+#  by the compositor are always EXR files and the backend only chooses
+#  their codec. Arrays written by TMB itself are saved in the backend format.
+#  Any stored file is loaded by its extension
+
+class TMB_StorageEXR(TMB_EXR):
+    '''Uncompressed OpenEXR, memory-mapped on load'''
+
+    extension = '.exr'
+    codec = 'NONE'
+
+    def save(self, path, channels):
+        self.exr_write(path, channels)
+
+    def load(self, path):
+        return self.exr_channels(path)
+
+class TMB_StorageNPY():
+    '''
+    Raw .npy file of (height, width) structured array with a field
+    per channel, base of TMB_StorageZLIB. Not offered as a storage:
+    compositor subframes would be uncompressed EXR anyway
+    '''
+
+    extension = '.npy'
+    codec = 'NONE'
+
+    def array(self, channels):
+        '''Return channels packed to one structured array'''
+
+        _names = sorted(channels.keys())
+        _array = np.empty(
+            channels[_names[0]].shape,
+            dtype = [(name, channels[name].dtype.str) for name in _names]
+        )
+        for name in _names:
+            _array[name] = channels[name]
+        return _array
+
+    def channels(self, array):
+        '''Return header and channels of structured array'''
+
+        _h, _w = array.shape
+        header = {
+            "channels" : [
+                (name, array.dtype[name].str) for name in array.dtype.names
+            ],
+            "compression" : 'NONE',
+            "width" : _w,
+            "height" : _h,
+        }
+        return header, {name : array[name] for name in array.dtype.names}
+
+    def save(self, path, channels):
+        np.save(path, self.array(channels), allow_pickle = False)
+
+    def load(self, path):
+        return self.channels(
+            np.load(path, mmap_mode = 'r', allow_pickle = False)
+        )
+
+class TMB_StorageZLIB(TMB_StorageNPY):
+    '''
+    .npy header followed by zlib compressed data, for slow disks.
+    Compositor subframes are saved as ZIP (zlib) compressed EXR
+    '''
+
+    extension = '.zlib'
+    codec = 'ZIP'
+    level = 1
+
+    def save(self, path, channels):
+        _array = self.array(channels)
+        with open(path, 'wb') as fh:
+            np.lib.format.write_array_header_1_0(fh, {
+                'descr' : np.lib.format.dtype_to_descr(_array.dtype),
+                'fortran_order' : False,
+                'shape' : _array.shape,
+            })
+            fh.write(zlib.compress(_array.tobytes(), self.level))
+
+    def load(self, path):
+        with open(path, 'rb') as fh:
+            np.lib.format.read_magic(fh)
+            _shape, _fortran, _dtype = np.lib.format.read_array_header_1_0(fh)
+            _data = zlib.decompress(fh.read())
+        return self.channels(
+            np.frombuffer(_data, dtype = _dtype).reshape(_shape)
+        )
+
+STORAGE = {
+    'EXR' : TMB_StorageEXR,
+    'ZLIB' : TMB_StorageZLIB,
+}
+
+class TMB_Storage():
+    '''Access to subframes storage backends'''
+
+    def storage(self, name):
+        '''Return storage backend by name (see STORAGE)'''
+
+        return STORAGE[name]()
+
+    def storage_save(self, path, channels, name, half = False):
+        '''
+        Save dict {channel name : (height, width) array} with the backend,
+        as float16 if half is True.
+        Return the path with the backend extension
+        '''
+
+        if half:
+            channels = {
+                key : arr.astype(np.float16) for key, arr in channels.items()
+            }
+        _backend = self.storage(name)
+        if not path.endswith(_backend.extension):
+            path += _backend.extension
+        _backend.save(path, channels)
+        return path
+
+    def storage_load(self, path):
+        '''Return header and channels of a file of any storage backend'''
+
+        for _backend in STORAGE.values():
+            if path.lower().endswith(_backend.extension):
+                return _backend().load(path)
+        raise ValueError(f'Unknown subframe storage file: {path}')
+
+#------------------------------- Threads Pool ----------------------------------
+
+class TMB_Pool(TMB_Storage, TMB_EXR):
+    '''
+    Thread pool decoding subframes files of any storage backend
+    and adding them to running sums.
+    Numpy and zlib release the GIL, so passes and subframes are decoded
+    in parallel. Additions to one running sum are serialized by its lock
+    '''
+
+    pool = None
+    futures = []
+    locks = {}
+    local = threading.local()
+
+    def pool_start(self, threads = 0):
+        '''Start pool with number of threads, 0 for all CPU cores'''
+
+        self.pool = ThreadPoolExecutor(
+            max_workers = threads or os.cpu_count() or 1
+        )
+        self.futures = []
+        self.locks = {}
+
+    def pool_stop(self):
+        '''Wait for all jobs and shut the pool down'''
+
+        if self.pool:
+            self.pool.shutdown(wait = True)
+        self.pool = None
+        self.futures = []
+        self.locks = {}
+
+    def pool_submit(self, func, *args, **kwargs):
+        '''Run func(*args, **kwargs) in the pool'''
+
+        self.futures.append(self.pool.submit(func, *args, **kwargs))
+
+    def pool_wait(self):
+        '''Wait until all submitted jobs are done, raise the first error'''
+
+        _futures = self.futures
+        self.futures = []
+        for future in _futures:
+            future.result()
+
+    def pool_scratch(self, size):
+        '''Return float32 array of size reused by the current thread'''
+
+        _scratch = getattr(self.local, 'scratch', None)
+        if _scratch is None or _scratch.size != size:
+            _scratch = np.empty(size, dtype='f')
+            self.local.scratch = _scratch
+        return _scratch
+
+    def pool_add(self, path, targets, delete = True, weight = 1):
+        '''
+        Submit subframe file decoding and adding its layers to running sums.
+        targets: [(key, (passes, pixels) running sums array,
+        [rows], [layer names])].
+        Layers are multiplied by weight if it isn't 1.
+        Delete file afterwards if delete is True
+        '''
+
+        _targets = []
+        for key, array, rows, layers in targets:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            _targets.append((self.locks[key], array, list(rows), layers))
+        self.pool_submit(self.pool_add_job, path, _targets, delete, weight)
+
+    def pool_add_job(self, path, targets, delete, weight = 1):
+        header, channels = self.storage_load(path)
+        for lock, array, rows, layers in targets:
+            _scratch = self.pool_scratch(len(rows) * array.shape[1])
+            _scratch = _scratch.reshape(len(rows), array.shape[1])
+            for num, layer in enumerate(layers):
+                self.exr_layer_to_pixels(
+                    header, channels, _scratch[num], layer, False
+                )
+            if weight != 1:
+                _scratch *= weight
+            #------- contiguous rows are added through a view, without a copy
+            if rows == list(range(rows[0], rows[0] + len(rows))):
+                _rows = slice(rows[0], rows[0] + len(rows))
+            else:
+                _rows = rows
+            with lock:
+                array[_rows] += _scratch
+        del channels
+        if delete:
+            os.remove(path)
+
+    def pool_divide(self, arrays, weights):
+        '''
+        Divide (passes, pixels) arrays in place by their passes weights
+        in parallel, one batched operation per array.
+        Rows with zero weight are left untouched
+        '''
+
+        for arr, weight in zip(arrays, weights):
+            _weight = np.asarray(weight, dtype='f')[:, None]
+            if _weight.any():
+                self.pool_submit(
+                    np.divide, arr, _weight, arr, where = _weight != 0
+                )
+        self.pool_wait()
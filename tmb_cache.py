@@ -0,0 +1,159 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+#  True Motion Blur add-on
+#  TMB subframes cache
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Module doesn't import bpy: cache keys are made of plain data
+#  and RNA structs are only read through their bl_rna descriptions
+
+import os, json, time, shutil, hashlib
+import numpy as np
+
+class TMB_Cache():
+    '''
+    Subframes files kept between renders in folders named by the hash
+    of everything the files depend on, so a render with the same scenes
+    finds them instead of rendering. Files are added through hard links,
+    folders appear at once with os.rename. Folder modification time
+    is its last use: least recently used folders are removed
+    when the cache is bigger than limit bytes
+    '''
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        os.makedirs(path, exist_ok = True)
+
+    @staticmethod
+    def key(*parts):
+        '''Return hash of JSON representable parts'''
+
+        _data = json.dumps(parts, default = str)
+        return hashlib.sha1(_data.encode()).hexdigest()
+
+    @staticmethod
+    def rna_values(struct, depth = 2, skip = (
+        'rna_type', 'filepath', 'depsgraph',
+        'layer_collection', 'active_layer_collection'
+    )):
+        '''
+        Return [(name, value)] of RNA properties of struct. Structs it owns
+        (e.g. display.shading) are followed depth levels down,
+        pointers to data-blocks and collections are not
+        '''
+
+        if struct is None:
+            return []
+        _values = []
+        for prop in struct.bl_rna.properties:
+            if prop.identifier in skip:
+                continue
+            if prop.type == 'POINTER':
+                _type = prop.fixed_type
+                while _type is not None and _type.identifier != 'ID':
+                    _type = _type.base
+                if depth and _type is None:
+                    _values.append((prop.identifier, TMB_Cache.rna_values(
+                        getattr(struct, prop.identifier), depth - 1, skip
+                    )))
+                continue
+            if prop.type not in {'BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM'}:
+                continue
+            _value = getattr(struct, prop.identifier)
+            if prop.type == 'ENUM' and prop.is_enum_flag:
+                _value = sorted(_value)
+            elif getattr(prop, 'array_length', 0):
+                _value = np.array(_value).tolist()
+            _values.append((prop.identifier, _value))
+        return _values
+
+    def folder(self, key):
+        return os.path.join(self.path, key, '')
+
+    def get(self, key):
+        '''Return folder of the cached files or None, mark it as used'''
+
+        _folder = self.folder(key)
+        try:
+            os.utime(_folder)
+        except OSError:
+            return None
+        return _folder
+
+    def add(self, key, files, move = False):
+        '''
+        Add files under key: hard link them (copy where links aren't
+        supported) or move them. Files already cached are not replaced,
+        files to move are removed then as the cache owns them anyway
+        '''
+
+        _folder = self.folder(key).rstrip(os.sep)
+        if not files:
+            return
+        if os.path.isdir(_folder):
+            if move:
+                for _file in files:
+                    try:
+                        os.remove(_file)
+                    except OSError:
+                        pass
+            return
+        _tmp = f'{_folder}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(_tmp, exist_ok = True)
+            for _file in files:
+                _dest = os.path.join(_tmp, os.path.basename(_file))
+                if move:
+                    shutil.move(_file, _dest)
+                    continue
+                try:
+                    os.link(_file, _dest)
+                except OSError:
+                    shutil.copy2(_file, _dest)
+            os.rename(_tmp, _folder)
+        except OSError: #------------------ added by another render right now
+            shutil.rmtree(_tmp, ignore_errors = True)
+
+    def evict(self, stale = 86400):
+        '''
+        Remove least recently used folders until the cache fits the limit,
+        and unfinished folders older than stale seconds
+        '''
+
+        _folders = []
+        _total = 0
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                _used = entry.stat().st_mtime
+                if entry.name.endswith('.tmp'):
+                    if time.time() - _used > stale:
+                        shutil.rmtree(entry.path, ignore_errors = True)
+                    continue
+                with os.scandir(entry.path) as files:
+                    _size = sum(fh.stat().st_size for fh in files)
+                _folders.append((_used, _size, entry.path))
+                _total += _size
+        for _used, _size, _path in sorted(_folders):
+            if _total <= self.limit:
+                break
+            shutil.rmtree(_path, ignore_errors = True)
+            _total -= _size
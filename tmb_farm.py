@@ -0,0 +1,281 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+#  True Motion Blur add-on
+#  TMB multi-process render
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Launcher of several background TMB renders of one file on one machine:
+#
+#  python tmb_farm.py -n 4 -b path/to/blender file.blend -- -s 1 -e 250
+#
+#  Options after "--" are passed to tmb_background.py of every worker.
+#  Workers claim frames through lock files next to the rendered frames,
+#  so each frame is rendered once, whatever the number of workers.
+#  The module doesn't import bpy: TMB_FrameLocks is also used by workers
+
+import os, sys, json, time, shutil, socket, pathlib, tempfile, argparse
+import subprocess
+
+def pid_alive(pid):
+    '''Return True if process with pid is running on this machine'''
+
+    if os.name == 'nt': #-------- os.kill() would terminate process on Windows
+        import ctypes
+        _kernel = ctypes.windll.kernel32
+        _handle = _kernel.OpenProcess(0x1000, False, pid)
+        if not _handle:
+            return False
+        _code = ctypes.c_ulong()
+        _kernel.GetExitCodeProcess(_handle, ctypes.byref(_code))
+        _kernel.CloseHandle(_handle)
+        return _code.value == 259 #---------------------------- STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+#--------------------------------- Frame Locks ---------------------------------
+
+class TMB_FrameLocks():
+    '''
+    Frames claiming through lock files shared by several renders.
+    "<name><frame>.tmb_lock" is linked atomically by the render which
+    claims the frame from a file with its host and pid.
+    "<name><frame>.tmb_done" marks the frame as saved by the run,
+    markers of other runs are ignored.
+    Lock of a dead process of this machine is taken over, as well as
+    lock which owner is still unreadable after broken seconds.
+    Locks of other machines are otherwise treated as alive
+    '''
+
+    def __init__(self, path, name = '', wait = 5.0, run = '', broken = 10.0):
+        self.path = str(path)
+        self.name = name
+        self.wait = wait
+        self.run = run
+        self.broken = broken
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        pathlib.Path(self.path).mkdir(parents = True, exist_ok = True)
+
+    def lock_path(self, frame, ext = 'tmb_lock'):
+        return os.path.join(self.path, f'{self.name}{frame:04d}.{ext}')
+
+    def is_done(self, frame):
+        try:
+            with open(self.lock_path(frame, 'tmb_done')) as fh:
+                return fh.read() == self.run
+        except OSError:
+            return False
+
+    def owner(self, frame):
+        '''Return {"host", "pid", "stamp"} of the frame lock or None'''
+
+        _lock = self.lock_path(frame)
+        try:
+            _stamp = os.stat(_lock).st_mtime_ns
+            with open(_lock) as fh:
+                _owner = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except ValueError: #-------------- written without link, or broken
+            return {"host" : None, "pid" : None, "stamp" : _stamp}
+        _owner['stamp'] = _stamp
+        return _owner
+
+    def is_stale(self, owner):
+        '''
+        Return True if the lock owner is a dead process of this machine
+        or the lock is unreadable for longer than broken seconds
+        '''
+
+        if owner and owner['pid'] is None:
+            return time.time_ns() - owner['stamp'] > self.broken * 1e9
+        return bool(
+            owner and
+            owner['host'] == self.host and
+            owner['pid'] != self.pid and
+            not pid_alive(owner['pid'])
+        )
+
+    def take_over(self, frame, owner):
+        '''
+        Remove stale lock. Only the render which creates the ".stale" marker
+        of this very lock removes it, so a fresh lock of a running render
+        is never removed by renders which saw the stale one.
+        Return True if removed
+        '''
+
+        _lock = self.lock_path(frame)
+        _marker = f'{_lock}.{owner["pid"]}.{owner["stamp"]}.stale'
+        try:
+            os.close(os.open(_marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            os.remove(_lock)
+        except OSError:
+            return False
+        return True
+
+    def claim(self, frame):
+        '''Try to lock the frame for this process. Return True on success'''
+
+        if self.is_done(frame):
+            return False
+        _lock = self.lock_path(frame)
+        _owner = self.owner(frame)
+        if self.is_stale(_owner) and not self.take_over(frame, _owner):
+            return False
+        _tmp = f'{_lock}.{self.pid}.tmp'
+        with open(_tmp, 'w') as fh:
+            json.dump({"host" : self.host, "pid" : self.pid}, fh)
+        try:
+            os.link(_tmp, _lock) #------------ lock appears with its owner
+        except FileExistsError:
+            return False
+        except OSError: #-------------------- file system without hard links
+            try:
+                _fd = os.open(_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+            with os.fdopen(_fd, 'w') as fh:
+                json.dump({"host" : self.host, "pid" : self.pid}, fh)
+        finally:
+            os.remove(_tmp)
+        if self.is_done(frame): #------- finished right before the lock was made
+            self.release(frame)
+            return False
+        return True
+
+    def claim_next(self, frames):
+        '''
+        Claim the first free frame of frames and return it.
+        While all not done frames are locked by running renders wait
+        for them to finish or die. Return None when all frames are done
+        '''
+
+        while True:
+            _pending = [fr for fr in frames if not self.is_done(fr)]
+            if not _pending:
+                return None
+            for frame in _pending:
+                if self.claim(frame):
+                    return frame
+            time.sleep(self.wait)
+
+    def done(self, frame):
+        '''Mark the frame as saved, release its lock and stale markers'''
+
+        _done = self.lock_path(frame, 'tmb_done')
+        with open(f'{_done}.{self.pid}.tmp', 'w') as fh:
+            fh.write(self.run)
+        os.replace(f'{_done}.{self.pid}.tmp', _done)
+        self.release(frame)
+        for _marker in pathlib.Path(self.path).glob(
+            f'{self.name}{frame:04d}.tmb_lock.*.stale'
+        ):
+            _marker.unlink()
+
+    def release(self, frame):
+        try:
+            os.remove(self.lock_path(frame))
+        except FileNotFoundError:
+            pass
+
+    def save(self, folder):
+        '''Save where the locks are, for the launcher to clean them up'''
+
+        with open(os.path.join(folder, 'tmb_locks.json'), 'w') as fh:
+            json.dump({"path" : self.path, "name" : self.name}, fh)
+
+    @classmethod
+    def load(cls, folder, run):
+        '''Return locks of the run saved to the folder or None'''
+
+        try:
+            with open(os.path.join(folder, 'tmb_locks.json')) as fh:
+                _data = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        return cls(_data['path'], _data['name'], run = run)
+
+    def clean(self):
+        '''Remove done markers of the run, they mean nothing to other runs'''
+
+        for _done in pathlib.Path(self.path).glob(f'{self.name}*.tmb_done'):
+            try:
+                if _done.read_text() == self.run:
+                    _done.unlink()
+            except OSError:
+                pass
+
+#---------------------------------- Launcher -----------------------------------
+
+def main():
+    _argv = sys.argv[1:]
+    _worker_argv = []
+    if '--' in _argv:
+        _worker_argv = _argv[_argv.index('--') + 1:]
+        _argv = _argv[:_argv.index('--')]
+    _parser = argparse.ArgumentParser(
+        prog = 'tmb_farm.py',
+        description = 'Render one file with several background TMB renders'
+    )
+    _parser.add_argument('blend', help = '.blend file to render')
+    _parser.add_argument(
+        '-n', '--workers', type = int, default = 2,
+        help = 'number of Blender processes'
+    )
+    _parser.add_argument(
+        '-b', '--blender', default = os.environ.get('BLENDER', 'blender'),
+        help = 'Blender executable ($BLENDER or "blender" by default)'
+    )
+    _parser.add_argument(
+        '-t', '--threads', type = int, default = 0,
+        help = 'render threads per worker, 0 to split CPU cores evenly'
+    )
+    args = _parser.parse_args(_argv)
+    _threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    _script = str(pathlib.Path(__file__).resolve().parent / 'tmb_background.py')
+    _temp = tempfile.gettempdir()
+    #------------------ frames done by previous runs follow Overwrite setting
+    _run = f'{socket.gethostname()}_{os.getpid()}_{time.time_ns()}'
+    _tempdirs = []
+    _workers = []
+    for num in range(args.workers):
+        _tempdir = os.path.join(_temp, f'_TMB_Worker_{os.getpid()}_{num}')
+        _tempdirs.append(_tempdir)
+        _workers.append(subprocess.Popen([
+            args.blender, '-b', args.blend, '-t', str(_threads),
+            '--python-exit-code', '1', '--python', _script, '--',
+            *_worker_argv, '--claim', '--run', _run, '--tempdir', _tempdir
+        ]))
+    _codes = [worker.wait() for worker in _workers]
+    #--------------- markers of a failed run show which frames were saved
+    for _tempdir in _tempdirs:
+        _locks = TMB_FrameLocks.load(_tempdir, _run)
+        if _locks and not any(_codes):
+            _locks.clean()
+        shutil.rmtree(_tempdir, ignore_errors = True)
+    #------------------------- workers killed by a signal have negative codes
+    sys.exit(next((1 if code < 0 else code for code in _codes if code), 0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+#  True Motion Blur add-on
+#  TMB out-of-process mixer
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  The same file is imported by the add-on (TMB_Mixer client) and is run
+#  by Blender's Python as the helper process (main function), so it must
+#  never import bpy
+
+import sys, json, pathlib, subprocess, multiprocessing
+import numpy as np
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: #------------------------------------------ Python < 3.8
+    shared_memory = None
+if __package__:
+    from .tmb_buffers import TMB_Pool
+else:
+    from tmb_buffers import TMB_Pool
+
+#----------------------------------- Client ------------------------------------
+
+class TMB_Mixer():
+    '''
+    Client of the mixer helper process.
+    For each Render Layer keeps one shared memory block with float32
+    (passes + 1, pixels) array: running sums of the passes
+    (handed back as the mixed result) and staging row for pixels
+    '''
+
+    def __init__(self, python, threads = 0):
+        self.python = python
+        self.threads = threads
+        self.process = None
+        self.blocks = {}
+        self.arrays = {}
+        self.staging = {}
+
+    @classmethod
+    def available(cls):
+        '''Return True if Python has multiprocessing.shared_memory'''
+
+        return shared_memory is not None
+
+    def start(self):
+        '''Start helper process'''
+
+        if self.python != sys.executable:
+            # resource tracker is started with multiprocessing executable
+            multiprocessing.set_executable(self.python)
+        self.process = subprocess.Popen(
+            [
+                self.python,
+                str(pathlib.Path(__file__).resolve()),
+                str(self.threads)
+            ],
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            universal_newlines = True,
+            bufsize = 1,
+        )
+
+    def send(self, **cmd):
+        '''Send command to helper process'''
+
+        if self.process.poll() is not None:
+            raise RuntimeError('TMB mixer process has stopped')
+        self.process.stdin.write(json.dumps(cmd) + '\n')
+        self.process.stdin.flush()
+
+    def reply(self):
+        '''Wait for helper process reply and return it'''
+
+        _line = self.process.stdout.readline()
+        if not _line:
+            raise RuntimeError('TMB mixer process has stopped')
+        _reply = json.loads(_line)
+        if 'error' in _reply:
+            raise RuntimeError(f'TMB mixer: {_reply["error"]}')
+        return _reply
+
+    def alloc(self, key, rows, size):
+        '''
+        Create shared memory for the Render Layer and return its
+        (rows, size) running sums array,
+        which holds the mixed result after finish()
+        '''
+
+        _block = shared_memory.SharedMemory(
+            create = True, size = (rows + 1) * size * 4
+            )
+        self.blocks[key] = _block
+        _all = np.ndarray((rows + 1, size), dtype = 'f', buffer = _block.buf)
+        _all.fill(0)
+        self.arrays[key] = _all[:rows]
+        self.staging[key] = _all[rows]
+        self.send(
+            cmd = 'alloc', key = key, name = _block.name,
+            rows = rows, size = size
+            )
+        return self.arrays[key]
+
+    def reset(self):
+        '''Zero all running sums'''
+
+        self.send(cmd = 'reset')
+
+    def add_file(self, path, targets, delete = True, weight = 1):
+        '''
+        Add subframe file layers weight times to the passes running sums
+        (asynchronous), then delete the file if delete is True.
+        targets: [(Render Layer key, [rows], [layer names])]
+        '''
+
+        _targets = [ #--------------- rows may be numpy index arrays
+            (key, [int(row) for row in rows], list(layers))
+            for key, rows, layers in targets
+        ]
+        self.send(
+            cmd = 'file', path = path, targets = _targets, delete = delete,
+            weight = weight
+            )
+
+    def add_block(self, key, row, weight = 1):
+        '''Add Render Layer staging array weight times to the pass running sum'''
+
+        self.send(cmd = 'block', key = key, row = row, weight = weight)
+        self.reply()
+
+    def finish(self):
+        '''
+        Wait until all subframes are added and divided by their weights.
+        Return {key : [weight of each row]}
+        '''
+
+        self.send(cmd = 'finish')
+        return self.reply()['weights']
+
+    def stop(self):
+        '''Stop helper process and release shared memory'''
+
+        if self.process and self.process.poll() is None:
+            try:
+                self.send(cmd = 'quit')
+                self.process.wait(timeout = 10)
+            except Exception:
+                self.process.kill()
+        self.process = None
+        self.arrays = {}
+        self.staging = {}
+        for _block in self.blocks.values():
+            try:
+                _block.close()
+            except BufferError: #--------- result arrays are still referenced
+                pass
+            _block.unlink()
+        self.blocks = {}
+
+#------------------------------- Helper Process --------------------------------
+
+class TMB_MixerWorker(TMB_Pool):
+    '''Decode and sum subframes into shared memory running sums'''
+
+    def __init__(self, threads = 0):
+        self.pool_start(threads)
+        self.blocks = {}
+        self.arrays = {}
+        self.staging = {}
+        self.weights = {}
+        self.error = None
+
+    def alloc(self, key, name, rows, size):
+        _block = shared_memory.SharedMemory(name = name)
+        # the block is owned and unlinked by the client
+        resource_tracker.unregister(_block._name, 'shared_memory')
+        self.blocks[key] = _block
+        _all = np.ndarray((rows + 1, size), dtype = 'f', buffer = _block.buf)
+        self.arrays[key] = _all[:rows]
+        self.staging[key] = _all[rows]
+        self.weights[key] = np.zeros(rows)
+
+    def reset(self):
+        try:
+            self.pool_wait()
+        except Exception: #------------------ aborted frame, nothing to report
+            pass
+        for key in self.arrays:
+            self.arrays[key].fill(0)
+            self.weights[key].fill(0)
+        self.error = None
+
+    def add_file(self, path, targets, delete = True, weight = 1):
+        self.pool_add(path, [
+            (key, self.arrays[key], rows, layers)
+            for key, rows, layers in targets
+        ], delete, weight)
+        for key, rows, layers in targets:
+            self.weights[key][rows] += weight
+
+    def add_block(self, key, row, weight = 1):
+        if weight != 1:
+            self.staging[key] *= weight
+        self.arrays[key][row] += self.staging[key]
+        self.weights[key][row] += weight
+
+    def finish(self):
+        self.pool_wait()
+        _keys = list(self.arrays.keys())
+        self.pool_divide(
+            [self.arrays[key] for key in _keys],
+            [self.weights[key] for key in _keys]
+        )
+        return {key : list(w) for key, w in self.weights.items()}
+
+    def run(self, stdin, stdout):
+        '''Commands loop'''
+
+        for _line in stdin:
+            cmd = json.loads(_line)
+            _reply = None
+            try:
+                if cmd['cmd'] == 'quit':
+                    break
+                elif cmd['cmd'] == 'alloc':
+                    self.alloc(
+                        cmd['key'], cmd['name'], cmd['rows'], cmd['size']
+                        )
+                elif cmd['cmd'] == 'reset':
+                    self.reset()
+                elif cmd['cmd'] == 'file':
+                    self.add_file(
+                        cmd['path'], cmd['targets'], cmd.get('delete', True),
+                        cmd.get('weight', 1)
+                        )
+                elif cmd['cmd'] == 'block':
+                    self.add_block(cmd['key'], cmd['row'], cmd.get('weight', 1))
+                    _reply = {}
+                elif cmd['cmd'] == 'finish':
+                    _reply = {'weights' : self.finish()}
+            except Exception as err:
+                self.error = f'{type(err).__name__}: {err}'
+                if cmd['cmd'] in ('block', 'finish'):
+                    _reply = {}
+            if _reply is not None:
+                if self.error:
+                    _reply = {'error' : self.error}
+                    self.error = None
+                stdout.write(json.dumps(_reply) + '\n')
+                stdout.flush()
+        self.pool_stop()
+        self.arrays = {}
+        self.staging = {}
+        for _block in self.blocks.values():
+            _block.close()
+
+def main():
+    _threads = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    TMB_MixerWorker(_threads).run(sys.stdin, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+#  True Motion Blur add-on
+#  TMB render model
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Module doesn't import bpy: Blender nodes are only kept as references.
+#  Setup operators collect the project into TMB_OT_store.store dicts,
+#  the render loop uses these slotted objects compiled from them
+
+import os, math
+import numpy as np
+
+class TMB_Buffer():
+    '''
+    float32 (passes, pixels) running sums of a TMB Render Layer
+    and number of subframes added to each row
+    '''
+
+    __slots__ = ('key', 'array', 'weights')
+
+    def __init__(self, key, array):
+        self.key = key
+        self.array = array
+        self.weights = np.zeros(len(array))
+
+    def reset(self, array = True):
+        if array:
+            self.array.fill(0)
+        self.weights.fill(0)
+
+class TMB_Pass():
+    '''Render pass of a TMB Render Layer'''
+
+    __slots__ = (
+        'npass', 'image', 'buffer', 'row', 'array',
+        'file_output', 'path', 'layer', 'capture'
+    )
+
+    def __init__(self, npass, sets):
+        self.npass = npass
+        self.image = sets.get('image')
+        self.buffer = sets.get('buffer')
+        self.row = sets.get('row')
+        self.array = sets.get('array')
+        self.file_output = sets.get('file_output')
+        self.path = sets.get('path')
+        self.layer = sets.get('layer', '')
+        self.capture = sets.get('capture', False)
+
+    def mixed(self):
+        '''Return True if any subframe was added to the pass'''
+
+        return bool(self.buffer.weights[self.row])
+
+class TMB_Layer():
+    '''
+    Render Layer of the render plan:
+    its TMB File Outputs with their folders, all passes in buffer rows order
+    and index arrays of enabled passes rendered to each subframes folder
+    '''
+
+    __slots__ = (
+        'scene', 'rlayer', 'tmb', 'buffer', 'outputs', 'passes',
+        'groups', 'captures'
+    )
+
+    def __init__(self, scene, rlayer, tmb, buffer, passes):
+        self.scene = scene
+        self.rlayer = rlayer
+        self.tmb = tmb
+        self.buffer = buffer
+        self.passes = passes
+        _outputs = {}
+        _groups = {}
+        self.captures = []
+        for _pass in passes:
+            if _pass.file_output: #--------- multilayer one is shared
+                _outputs[_pass.file_output] = _pass.path
+            if not _pass.npass.enabled:
+                continue
+            if _pass.capture:
+                self.captures.append(_pass)
+                continue
+            _groups.setdefault(_pass.path, []).append(_pass)
+        self.outputs = list(_outputs.items())
+        #------------- (folder, buffer rows, EXR layers) of files to sum up
+        self.groups = [
+            (
+                _path,
+                np.array([_pass.row for _pass in _passes], dtype = np.intp),
+                [_pass.layer for _pass in _passes]
+            ) for _path, _passes in _groups.items()
+        ]
+
+class TMB_Step():
+    '''
+    Precomputed render of one subframe: scenes frame and subframe,
+    mute states and paths to set, unmuted TMB Render Layers
+    and weights of their subframe (number of subframes snapped to it),
+    Render Layers which files are kept for the next frame
+    '''
+
+    __slots__ = (
+        'subframe', 'frame', 'offset', 'mute', 'paths', 'layers', 'weights',
+        'keep'
+    )
+
+    def __init__(self, subframe):
+        self.subframe = subframe
+        self.frame = math.floor(subframe) #------ subframes before frame 0 too
+        self.offset = round(subframe - self.frame, 4)
+        self.mute = []
+        self.paths = []
+        self.layers = []
+        self.weights = []
+        self.keep = []
+
+    def folder(self, path):
+        '''Return subframe folder in the File Output folder path'''
+
+        return os.path.join(path, str(self.subframe), '')
+
+    def set_paths(self):
+        '''Set File Outputs folders, only changed paths are written'''
+
+        for _fo, _path in self.paths:
+            if _fo.base_path != _path:
+                _fo.base_path = _path
+
+    def set_mute(self):
+        '''Set nodes mute states, only changed states are written'''
+
+        for node, _mute in self.mute:
+            if node.mute != _mute:
+                node.mute = _mute
+
+def compile_plan(layers, weights, subframes, carried = (), shared = {}):
+    '''
+    Return render plan of the frame subframes: { subframe : TMB_Step }.
+    layers: TMB_Layer list, weights: { scene : { subframe : weight } }
+    of the frame, carried: subframes which files were kept by the previous
+    frame, shared: { subframe : scenes of the next frame rendering it },
+    their Render Layers are rendered with this frame and kept
+    '''
+
+    _plan = {}
+    for _subfr in subframes:
+        _step = TMB_Step(_subfr)
+        #-------------- carried subframe files were kept for this frame only
+        _next = () if _subfr in carried else shared.get(_subfr, ())
+        for _layer in layers:
+            sc = _layer.scene
+            # if this is a non-TMB layer, rendered with the last subframe,
+            # or current subframe is not in this RL's scene subframes list
+            # of this frame or the next one:
+            # mute Render Layer. Or unmute otherwise.
+            _mute = not _layer.tmb or (
+                _subfr not in weights[sc] and sc not in _next
+            )
+            _step.mute.append((_layer.rlayer, _mute))
+            if not _layer.tmb:
+                continue
+            # mute or unmute TMB subframes File Outputs
+            # depending on mute status of Render Layer
+            for _fo, _path in _layer.outputs:
+                _step.mute.append((_fo, _mute))
+                _step.paths.append((_fo, _step.folder(_path)))
+            if sc in _next:
+                _step.keep.append(_layer)
+            if not _mute and _subfr in weights[sc]:
+                _step.layers.append(_layer)
+                _step.weights.append(weights[sc][_subfr])
+        _plan[_subfr] = _step
+    return _plan
@@ -20,9 +20,15 @@
 #  TMB Render
 #  (c) 2020 Andrey Sokolov (so_records)
 
-import bpy, time, datetime, pathlib, shutil
+import bpy, sys, time, bisect, datetime, pathlib, shutil
 import numpy as np
-from .tmb_support import TMB_Helpers
+from .tmb_support import TMB_Helpers, TMB_SceneState
+from .tmb_buffers import TMB_Pixels, TMB_Pool
+from .tmb_mixer import TMB_Mixer
+from .tmb_farm import TMB_FrameLocks
+from .tmb_resume import TMB_Manifest
+from .tmb_cache import TMB_Cache
+from .tmb_model import TMB_Buffer, TMB_Pass, TMB_Layer, compile_plan
 from bpy.props import BoolProperty, StringProperty, IntProperty
 from bpy.utils import register_class, unregister_class
 from time import perf_counter
@@ -30,10 +36,17 @@ from time import perf_counter
 #------------------ Add and remove Viewer for correct preview ------------------
 
 class TMB_UpdatePreview(bpy.types.Operator):
-    '''Add and remove Viewer to update render preview display'''
+    '''
+    Add and remove Viewer to update render preview display.
+    The Viewer is removed once the compositor has written the Viewer image:
+    handlers count compositor updates, so the timer only compares numbers
+    '''
     bl_idname = "tmb.update"
     bl_label = "Update Preview"
     
+    generation = 0
+    start = None
+    handler = None
     store = None
     project = None
     sc = None
@@ -63,9 +76,38 @@ class TMB_UpdatePreview(bpy.types.Operator):
             if 'Viewer Node' in bpy.data.images else
             bpy.data.images.new('Viewer Node', self.resx, self.resy)
             )
-        self.viewer_image.pixels[:] = np.ones(
-            len(self.viewer_image.pixels))[:]
         self.timer = None
+        
+        def _updated(*args):
+            '''composite_post/render_post handler function'''
+            
+            TMB_UpdatePreview.generation += 1
+        
+        self.handler = _updated
+        self.start = TMB_UpdatePreview.generation
+    
+    def handlers(self):
+        '''
+        Return handler lists run after the Viewer image is written:
+        composite_post where Blender has it and render_post
+        '''
+        
+        _handlers = bpy.app.handlers
+        return [
+            _list for _list in (
+                getattr(_handlers, 'composite_post', None),
+                _handlers.render_post
+            ) if _list is not None
+        ]
+    
+    def handler_add(self):
+        for _list in self.handlers():
+            _list.append(self.handler)
+    
+    def handler_remove(self):
+        for _list in self.handlers():
+            while self.handler in _list:
+                _list.remove(self.handler)
     
     def timer_add(self, tick=0.01):
         '''Add timer event and set it as self.timer'''
@@ -91,6 +133,9 @@ class TMB_UpdatePreview(bpy.types.Operator):
         self.viewer = None
         
     def cleanup(self):
+        self.handler_remove()
+        self.handler = None
+        self.start = None
         self.viewer_image = None
         self.viewer = None
         self.wm = None
@@ -106,19 +151,19 @@ class TMB_UpdatePreview(bpy.types.Operator):
     def execute(self, context):
         self.structure()
         self.viewer_add()
+        self.handler_add()
         self.timer_add()
         self.wm.modal_handler_add(self)
         return {'RUNNING_MODAL'}
     
     def modal(self, context, event):
         if event.type == 'ESC':
+            self.timer_remove()
+            self.viewer_remove()
             self.cleanup()
             return {'CANCELLED'}
         elif event.type == 'TIMER':
-            if (
-                self.viewer_image.pixels ==
-                np.ones(len(self.viewer_image.pixels)).all()
-            ):
+            if TMB_UpdatePreview.generation == self.start:
                 return {'PASS_THROUGH'}
             else:
                 self.timer_remove()
@@ -138,22 +183,35 @@ class TMB_RenderVariables(TMB_Helpers, bpy.types.Operator):
     bl_label = "Render Variables"
     
     frames = []
-    passes = []
-    images = []
+    plan_step = None
+    ticks = 10000 #--------------------------- subframe time steps per frame
     frame = None
     subframe = None
     rendering_frame = None
     rendering_subframe = None
-    started = None
     handler_complete = None
     handler_pre = None
     handler_final = None
     viewer = None
     timer = None
     final_completed = None
-    skipped_frame = None
+    subframe_completed = None
+    mixer = None
+    manifest = None
+    capture_warned = None
+    cache = None
+    cache_scenes = {}
+    step = None
+    step_poll = 0.005 #-------- seconds between render_step checks of renders
+    pending = None
+    finished = None
+    idle_start = None
+    idle_time = 0.0
+    idle_count = 0
     
-class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
+class TMB_RenderHelpers(
+    TMB_RenderVariables, TMB_Pixels, TMB_Pool, bpy.types.Operator
+):
     '''Render help functions'''
     bl_idname = "tmb_render.helpers"
     bl_label = "Render Helpers"
@@ -188,25 +246,38 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         self.sc = self.project['main_sc']
         self.variables.timer = None
         self.variables.rendering_subframe = None
-        self.variables.started = None
         self.variables.final_completed = None
+        self.variables.subframe_completed = None
+        self.variables.step = None
+        self.variables.pending = None
+        self.variables.finished = None
+        self.variables.capture_warned = False
+        self.variables.idle_start = None
+        self.variables.idle_time = 0.0
+        self.variables.idle_count = 0
         self.render_passes = self.project['render_passes']
-        bpy.ops.tmb.update('INVOKE_DEFAULT')        
-        self.viewer_image = bpy.data.images['Viewer Node']
+        if not self.restore['capture'] and not bpy.app.background:
+            bpy.ops.tmb.update('INVOKE_DEFAULT')
+        self.viewer_image = bpy.data.images.get('Viewer Node')
         
+        #----------- handlers run in the render job thread: they only set flags
+        #------------------- for render_step, which runs in the main thread
         def _complete(self, context):
             '''subframe render_complete handler function'''
             
             _vars = bpy.types.TMB_RENDER_OT_variables
-            _prj = bpy.types.TMB_OT_store.store['Project']
             _vars.rendering_subframe = False
-            _vars.started = False
+            _vars.subframe_completed = True
+            _vars.idle_start = perf_counter()
         
         def _pre(self, context):
-            '''subframe render_pre handler function'''
+            '''render_pre handler function, measures idle time of renders'''
             
             _vars = bpy.types.TMB_RENDER_OT_variables
-            _vars.started = True
+            if _vars.idle_start is not None:
+                _vars.idle_time += perf_counter() - _vars.idle_start
+                _vars.idle_count += 1
+                _vars.idle_start = None
             
         def _final_complete(self, context):
             '''mixing frame render_complete handler function'''
@@ -214,7 +285,7 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
             _vars = bpy.types.TMB_RENDER_OT_variables
             _vars.rendering_subframe = False
             _vars.final_completed = True
-            _vars.started = False
+            _vars.idle_start = perf_counter()
                     
         self.handler_complete = _complete
         self.handler_pre = _pre
@@ -224,7 +295,7 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         while self.handler_pre in bpy.app.handlers.render_pre:
             bpy.app.handlers.render_pre.remove(self.handler_pre)
         while self.handler_final in bpy.app.handlers.render_complete:
-            bpy.app.handlers.render_copmlete.remove(self.handler_final)
+            bpy.app.handlers.render_complete.remove(self.handler_final)
     
     def cleanup(self):
         '''Reset Operator variables'''
@@ -242,8 +313,7 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         self.sc = None
         self.render_passes = None
         self.frames = []
-        self.passes = []
-        self.images = []
+        self.plan_step = None
         self.frame = None
         self.subframe = None
         self.rendering_frame = None
@@ -253,13 +323,21 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         self.handler_pre = None
         self.viewer = None
         self.timer = None
-        self.skipped_frame = None
+        self.subframe_completed = None
+        self.manifest = None
+        if self.cache:
+            self.cache.evict()
+        self.cache = None
+        self.cache_scenes = {}
+        self.pixels_clear()
+        self.pool_stop()
         bpy.types.TMB_OT_store.store = {}
+        self.mixer_stop() #--------- after storage release its shared buffers
     
     def finalize(self):
         '''Restore project settings'''
         
-        if self.animation:
+        if self.animation and not bpy.app.background:
             bpy.ops.tmb.keyconfig()
         bpy.ops.tmb.restore()
     
@@ -276,62 +354,147 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         else:
             self.frames.append(sc.frame_current)
     
-    def get_subframes(self, sc):
-        '''Calculate subframes for current frame in certain scene'''
+    def frame_output(self, frame):
+        '''Return path the frame is saved to by the user Output settings'''
+        
+        _rnd = self.sc.render
+        _path = _rnd.filepath
+        _rnd.filepath = self.project['user_path']
+        _output = _rnd.frame_path(frame = frame)
+        _rnd.filepath = _path
+        return _output
+    
+    def frame_check(self, frame):
+        '''
+        Follow Blender Overwrite and Placeholders settings of animation:
+        return False if the frame is already saved (or placeholder of another
+        render exists) and Overwrite is off, otherwise write its placeholder
+        if Placeholders are on and return True.
+        Empty placeholder of a frame claimed through its lock or interrupted
+        by resumed render is left by a render which died, not saved frame
+        '''
+        
+        _rnd = self.sc.render
+        if not self.animation:
+            return True
+        _output = self.frame_output(frame)
+        if pathlib.os.path.exists(_output):
+            _ours = self.claim or (
+                self.manifest and self.manifest.data['frame'] == frame
+            )
+            if _ours and not pathlib.os.path.getsize(_output):
+                return True
+            return _rnd.use_overwrite
+        if _rnd.use_placeholder:
+            pathlib.Path(_output).parent.mkdir(parents=True, exist_ok=True)
+            pathlib.Path(_output).touch()
+        return True
+    
+    def frames_skip(self):
+        '''
+        Drop already saved frames from the start of the frames list,
+        so neither their subframes nor final mixing are rendered
+        '''
+        
+        while self.frames and not self.frame_check(self.frames[0]):
+            self.frames.pop(0)
+    
+    def tmb_settings(self, sc, frame):
+        '''
+        Return TMB settings of the scene in the frame: { setting : value }.
+        Animated settings are evaluated from their F-Curves, so the scene
+        frame isn't changed. It is set only if TMB settings have drivers
+        '''
         
         _tmb = sc.true_mb
-        _position = _tmb.position
-        _samples = _tmb.samples
-        _shutter = round(_tmb.shutter/2, 3 )
-        _frame = self.render['frame']
-        #-------------------------start and end subframes from the TMB position:
-        if _position == 'START':
-            _start = _frame
-            _end = _frame + _shutter*2
-        elif _position == 'FRAME':
-            _start = _frame - _shutter*2
-            _end = _frame
-        elif _position == 'CENTER':
-            _start = _frame - _shutter
-            _end = _frame + _shutter
-        #----------------------------------------------------------storage sync:
-        self.rlayers[sc]['subframes'] = []
-        subframes = self.rlayers[sc]['subframes']
-        conc_subframes = self.render['conc_subframes']
-        #----------------------------------------------store the first subframe:
-        subframes.append(_start) 
-        if _start not in conc_subframes:
-            conc_subframes.append(_start)
-        #--------------------------------------if the number of samples is even:    
-        if _samples % 2 == 0: 
-            _step = (_end - _start) / (_samples - 1 )
-            while round( (_start + _step), 4 ) <= _end:
-                _start += _step
-                _sub = round(_start, 4)
-                subframes.append(_sub)
-                if _sub not in conc_subframes:
-                    conc_subframes.append(_sub)
-        #---------------------------------------if the number of samples is odd:
-        else: 
-            _step = (self.frame - _start) / (_samples // 2 )
-            while round( (_start + _step), 4 ) <= _end:
-                _start += _step
-                _sub = round(_start, 4)
-                subframes.append(_sub)
-                if _sub not in conc_subframes:
-                    conc_subframes.append(_sub)
+        _names = ('position', 'shutter', 'samples', 'boost')
+        _anim = sc.animation_data
+        if _anim and any(
+            _anim.drivers.find(f'true_mb.{name}') for name in _names
+        ):
+            sc.frame_set(frame, subframe = 0.0)
+            _anim = None
+        _action = _anim.action if _anim else None
+        _settings = {}
+        for name in _names:
+            _fcurve = None
+            if _action:
+                _fcurve = _action.fcurves.find(f'true_mb.{name}')
+            if _fcurve is None:
+                _settings[name] = getattr(_tmb, name)
+                continue
+            _value = _fcurve.evaluate(frame)
+            _prop = _tmb.bl_rna.properties[name]
+            if _prop.type == 'ENUM':
+                _value = _prop.enum_items[int(round(_value))].identifier
+            elif _prop.type == 'INT':
+                _value = int(round(_value))
+            _settings[name] = _value
+        return _settings
+    
+    def get_subframes(self, frame, settings):
+        '''
+        Return set of subframes of the frame with TMB settings of a scene
+        as integer ticks (1/ticks of frame). Subframes are evenly spaced from
+        shutter open to close in closed form: no rounding drift adds or drops
+        a subframe and equal times of different scenes are equal ticks
+        '''
+        
+        _ticks = self.ticks
+        _span = round(settings['shutter'] * _ticks)
+        _frame = frame * _ticks
+        _n = settings['samples'] - 1
+        #------- offsets of subframes from the frame are (base + 2*i*span)/2n
+        #--------------------------------------- for the shutter position:
+        _base = {'START' : 0, 'CENTER' : -_n * _span, 'FRAME' : -2 * _n * _span}
+        _base = _base[settings['position']]
+        return {
+            _frame + (_base + 2 * i * _span + _n) // (2 * _n) #---- rounded
+            for i in range(_n + 1)
+        }
                     
-    def set_frame(self):
+    def snap_subframes(self, ticks):
         '''
-        Pop frame from project['frames']
-        Get subframes of the frame for all non-Cycles scenes with active TMB
-        Store concatenated scenes subframes lists
-            and store result into self.render['conc_subframes']
+        Move subframes of TMB scenes onto a shared time lattice, so scenes
+        with different settings render mostly the same subframes.
+        The lattice starts with subframes of the scene with most samples,
+        other scenes' subframes closer than Snap Subframes tolerance
+        to a lattice subframe are moved onto it, the rest join the lattice.
+        ticks: { scene : set of subframes ticks }
+        Return { scene : { tick : weight } }, weight is the number
+        of the scene subframes rendered at the tick
         '''
         
-        self.frame = self.render['frames'].pop(0)
-        self.render['frame'] = self.frame
-        self.render['conc_subframes'] = []
+        _tolerance = round(self.project['snap'] * self.ticks)
+        _lattice = []
+        _snapped = {}
+        for sc in sorted(ticks, key = lambda sc : -len(ticks[sc])):
+            _weights = _snapped[sc] = {}
+            _new = []
+            for _tick in sorted(ticks[sc]):
+                _num = bisect.bisect_left(_lattice, _tick)
+                _near = min(
+                    _lattice[max(0, _num - 1):_num + 1],
+                    key = lambda near : abs(near - _tick),
+                    default = None
+                )
+                if _near is not None and abs(_near - _tick) <= _tolerance:
+                    _tick = _near
+                else:
+                    _new.append(_tick)
+                _weights[_tick] = _weights.get(_tick, 0) + 1
+            _lattice = sorted(set(_lattice).union(_new))
+        return _snapped
+    
+    def frame_ticks(self, frame):
+        '''
+        Return subframes ticks of all non-Cycles scenes with active TMB
+        in the frame: { scene : { tick : weight } } (see snap_subframes)
+        and their TMB settings: { scene : { setting : value } }
+        '''
+        
+        _ticks = {}
+        _settings = {}
         for sc in list(self.scenes.keys()):
             if (
                 sc.render.engine != 'CYCLES' and
@@ -339,17 +502,127 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
                 self.rlayers[sc] and
                 self.rlayers[sc]['rlayers']
             ):
-                sc.frame_set(self.frame, subframe = 0.0)
-                self.get_subframes(sc)
-                self.scenes[sc]['tmb']['position'] = sc.true_mb.position
-                self.scenes[sc]['tmb']['shutter'] = sc.true_mb.shutter
-                self.scenes[sc]['tmb']['samples'] = sc.true_mb.samples
-                self.scenes[sc]['tmb']['boost'] = sc.true_mb.boost
-                
+                _settings[sc] = self.tmb_settings(sc, frame)
+                _ticks[sc] = self.get_subframes(frame, _settings[sc])
+        return self.snap_subframes(_ticks), _settings
+    
+    def frame_next(self):
+        '''
+        Return the frame rendered after the current one or None
+        if it is not known (claimed frames are taken by several renders)
+        '''
+        
+        if self.claim or not self.render['frames']:
+            return None
+        return self.render['frames'][0]
+    
+    def set_frame(self):
+        '''
+        Pop frame from project['frames']
+        Get subframes of the frame for all non-Cycles scenes with active TMB
+        Store unique subframes of all scenes
+            into self.render['conc_subframes']
+        Subframes shared with the next frame (shutter boundaries) are rendered
+        once: their files are kept in self.render['carry'] and added
+        to the next frame from disk (see carry_frame)
+        '''
+        
+        self.frame = self.render['frames'].pop(0)
+        self.render['frame'] = self.frame
+        _carry = self.render['carry']
+        self.render['carried'] = []
+        #------------- subframes of this frame were computed with the previous
+        if _carry and _carry['frame'] == self.frame:
+            _snapped, _settings = _carry['ticks'], _carry['settings']
+            self.render['carried'] = _carry['subframes']
+        else:
+            self.carry_remove() #---------------- the next frame was skipped
+            _snapped, _settings = self.frame_ticks(self.frame)
+        for sc in list(self.scenes.keys()):
+            if sc in _settings:
+                self.scenes[sc]['tmb'].update(_settings[sc])
             else:
                 self.rlayers[sc]['subframes']= [self.frame]
-        self.render['conc_subframes'].sort()
+                self.rlayers[sc]['weights'] = {self.frame : 1}
+        _conc = set()
+        for sc, _weights in _snapped.items():
+            _conc.update(_weights)
+            self.rlayers[sc]['subframes'] = [
+                _tick / self.ticks for _tick in sorted(_weights)
+            ]
+            self.rlayers[sc]['weights'] = {
+                _tick / self.ticks : _weight
+                for _tick, _weight in _weights.items()
+            }
+        #------------ subframe on the frame itself is rendered the last one
+        _on_frame = {self.frame * self.ticks}
+        self.render['conc_subframes'] = [
+            _tick / self.ticks
+            for _tick in sorted(_conc - _on_frame) + sorted(_conc & _on_frame)
+        ]
         self.render['conc_subframes'].append(self.frame) #------for final mixing
+        #------------- scenes of the next frame rendering the same subframes:
+        _next = self.frame_next()
+        _next_snapped, _next_settings = (
+            self.frame_ticks(_next) if _next is not None else ({}, {})
+        )
+        _shared = {}
+        for sc, _weights in _next_snapped.items():
+            for _tick in _conc.intersection(_weights):
+                _shared.setdefault(_tick / self.ticks, set()).add(sc)
+        self.plan_compile(_shared)
+        self.render['carry'] = None
+        if _next is not None:
+            self.render['carry'] = {
+                "frame" : _next,
+                "ticks" : _next_snapped,
+                "settings" : _next_settings,
+                "subframes" : [
+                    _subfr for _subfr, _step in self.render['plan'].items()
+                    if _step.keep
+                ],
+            }
+    
+    def plan_layers(self):
+        '''
+        Compile Render Layers part of the render plan once per render:
+        list of TMB_Layer in the main storage order
+        '''
+        
+        _layers = []
+        for sc, _sc_sets in self.rlayers.items():
+            _tmb = bool(
+                self.scenes[sc]['engine'] != 'CYCLES' and
+                self.scenes[sc]['tmb'] and
+                self.scenes[sc]['tmb']['activate']
+            )
+            for rl, _rl_sets in _sc_sets['rlayers'].items():
+                _passes = [
+                    TMB_Pass(npass, _sets) for npass, _sets in _rl_sets.items()
+                ]
+                _layers.append(TMB_Layer(
+                    sc, rl, _tmb, _sc_sets['buffers'].get(rl), _passes
+                ))
+        return _layers
+    
+    def plan_compile(self, shared = {}):
+        '''
+        Compile render plan of the frame into self.render["plan"]:
+        { subframe : TMB_Step }
+        Subframes lists are not walked while rendering anymore.
+        shared: { subframe : scenes of the next frame rendering it },
+        their Render Layers are rendered with this frame and kept
+        '''
+        
+        if not self.render['layers']:
+            self.render['layers'] = self.plan_layers()
+        self.render['plan'] = compile_plan(
+            self.render['layers'],
+            {sc : _sets['weights'] for sc, _sets in self.rlayers.items()},
+            self.render['conc_subframes'][:-1],
+            self.render['carried'],
+            shared
+        )
         
     def set_subframe(self):
         '''
@@ -357,21 +630,66 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         Set it as current project subframe
         '''
         
-        sc = self.sc
         self.render['subframe'] = self.render["conc_subframes"].pop(0)
-        if self.render['subframe'] == self.render['frame']:
-            if not self.skipped_frame:
-                self.render["conc_subframes"].append(self.render['subframe'])
-                self.render['subframe'] = self.render["conc_subframes"].pop(0)
-                self.skipped_frame = True
-            else:
-                self.skipped_frame = False            
-        _subfr = self.render['subframe']
-        _fr = int(_subfr) #------------------------------------------- set frame
-        _sbfr = round (_subfr - _fr, 3) #-------------------------- set subframe                
-        for scene in list(self.rlayers.keys()):
-            scene.frame_set(_fr, subframe=_sbfr) # -----------set current fr/sub
+        _step = self.render['plan'][self.render['subframe']]
+        for scene in self.rlayers: #------------------set current fr/sub
+            scene.frame_set(_step.frame, subframe=_step.offset)
+        _step.set_paths()
+        
+    def set_rlayers(self):
+        '''
+        Unmute TMB Render Layers if current subframe is in its scene's
+            subframes list. Only changed mute states are set
+        '''
+        
+        self.plan_step = self.render['plan'][self.render['subframe']]
+        self.plan_step.set_mute()
+    
+    def reset_images(self):
+        '''Replace all temporary image pixels with zeros'''
+        
+        for img in self.render['images']:
+            self.pixels_fill(img, 0.0)
+    
+    def mixer_start(self):
+        '''
+        Start mixer helper process if it is enabled and supported.
+        Return True if started
+        '''
+        
+        if not self.project['mixer']:
+            return False
+        if not TMB_Mixer.available():
+            _msg = "TMB Mixer Process needs Python 3.8+, mixing in Blender"
+            bpy.ops.tmb.warning('INVOKE_DEFAULT', type = 'WARNING', msg=_msg)
+            return False
+        _python = getattr(bpy.app, 'binary_path_python', '') or sys.executable
+        self.mixer = TMB_Mixer(_python, self.project['threads'])
+        self.mixer.start()
+        return True
+    
+    def mixer_stop(self):
+        '''Stop mixer helper process if it is running'''
+        
+        if self.mixer:
+            self.mixer.stop()
+            self.mixer = None
+    
+    def buffers_add(self):
+        '''
+        Preallocate one float32 (passes, pixels) running-sum buffer
+        per TMB Render Layer. Each pass buffer is a row of it.
+        Buffers are reused for all frames, so memory doesn't depend on samples.
+        With mixer process buffers are its shared memory blocks,
+        otherwise subframes are summed by the threads pool
+        '''
+        
+        _mixer = self.mixer_start()
+        if not _mixer:
+            self.pool_start(self.project['threads'])
+        _pix_len = self.project['pix_len']
         for sc in list(self.rlayers.keys()):
+            self.rlayers[sc]['buffers'] = {}
             if (
                 self.scenes[sc]['engine'] == 'CYCLES' or
                 not self.scenes[sc]['tmb'] or
@@ -380,68 +698,30 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
                 continue
             _rlayers = self.rlayers[sc]['rlayers']
             for rl in list(_rlayers.keys()):
-                for npass in list(_rlayers[rl].keys()):
-                    _fo = _rlayers[rl][npass]['file_output']
-                    _path = _rlayers[rl][npass]['path']
-                    _fo.base_path = pathlib.os.path.join(
-                        _path, str(self.render['subframe'])
-                    )
-        
-    def set_rlayers(self):
-        '''
-        Unmute TMB Render Layers if current subframe is in its scene's
-            subframes list.
-        '''
-        
-        self.images = []
-        self.passes = []
-        self.render['rlayers'] = []
-        for sc in list(self.rlayers.keys()):
-            _rlayers = self.rlayers[sc]['rlayers']            
-            for rl in list(_rlayers.keys()):
-                _mute = False
-                # if this is the last subframe, which is only for non-TMB layers
-                # or current subframe is not in this RL's scene subframes list:
-                # mute Render Layer. Or unmute otherwise.
-                if (
-                    len(self.rlayers[sc]['subframes']) == 1 or
-                    not self.render['subframe'] in self.rlayers[sc]['subframes']
-                ):
-                    _mute = True
-                rl.mute = _mute
-                            
-                if (
-                    self.scenes[sc]['engine'] == 'CYCLES' or
-                    not self.scenes[sc]['tmb'] or
-                    not self.scenes[sc]['tmb']['activate']
-                ):
+                _passes = list(_rlayers[rl].keys())
+                if not _passes:
                     continue
-                # if scene is non-Cycles, is TMB, and there are several scenes
-                # with different TMB settings: mute or unmute TMB subframes
-                # File Outputs depending on mute status of Render Layer
-                else:
-                    for npass in list(_rlayers[rl].keys()):
-                        _rlayers[rl][npass]['file_output'].mute = _mute
-                    
-                if _mute:
-                    continue
-                
-                # if Render Layer is not muted:
-                _rl_sets = self.rlayers[sc]['rlayers'][rl]
-                for npass in rl.outputs:
-                    if (
-                        npass.enabled and
-                        npass in list(_rl_sets.keys())
-                    ):
-                        _img = _rl_sets[npass]['image']
-                        self.images.append(_img)
-                        self.passes.append(npass)
+                _key = f'{sc.name}|{rl.layer}'
+                _buffer = TMB_Buffer(_key, (
+                    self.mixer.alloc(_key, len(_passes), _pix_len)
+                    if _mixer else
+                    np.zeros((len(_passes), _pix_len), dtype='f')
+                ))
+                self.rlayers[sc]['buffers'][rl] = _buffer
+                for row, npass in enumerate(_passes):
+                    _sets = _rlayers[rl][npass]
+                    _sets['buffer'] = _buffer
+                    _sets['row'] = row
+                    _sets['array'] = _buffer.array[row]
     
-    def reset_images(self):
-        '''Replace all temporary image pixels with numpy zeros arrays'''
+    def reset_buffers(self):
+        '''Zero all running-sum buffers before the next frame'''
         
-        for img in self.render['images']:
-            img.pixels[:] = np.zeros(self.project['pix_len'], dtype = 'f')[:]
+        if self.mixer:
+            self.mixer.reset()
+        for sc in self.rlayers:
+            for _buffer in self.rlayers[sc]['buffers'].values():
+                _buffer.reset(array = not self.mixer)
             
     def timer_add(self, tick=0.01):
         '''Add timer event and set it as self.timer'''
@@ -461,11 +741,34 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
             pass
         self.timer = None
     
+    def step_add(self):
+        '''
+        Register render_step to run by bpy.app.timers with no delay.
+        It stays registered and polls for completed renders
+        '''
+        
+        self.variables.step = self.render_step
+        bpy.app.timers.register(self.variables.step, first_interval = 0)
+    
+    def step_remove(self):
+        '''Unregister pending render step'''
+        
+        _step = bpy.types.TMB_RENDER_OT_variables.step
+        if _step and bpy.app.timers.is_registered(_step):
+            bpy.app.timers.unregister(_step)
+        bpy.types.TMB_RENDER_OT_variables.step = None
+    
+    def context_override(self):
+        '''Context for operators called from timers, which have no window'''
+        
+        _win = self.project['window']
+        return {'window' : _win, 'screen' : _win.screen, 'scene' : self.sc}
+    
     def render_native(self):
         '''Native Blender render operator for instant renders'''
         
         bpy.ops.render.render(
-            'INVOKE_DEFAULT',
+            'EXEC_DEFAULT' if bpy.app.background else 'INVOKE_DEFAULT',
             animation = self.animation,
             write_still = self.write_still,
             use_viewport = self.use_viewport,
@@ -474,74 +777,576 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
             )
     
     def render_subframe(self):
-        '''Main TMB subframe render operator'''
+        '''
+        Start pending TMB subframe (or final mixing frame) render.
+        Return interval of bpy.app.timers to wait for the render,
+        or to retry if previous render job is still finishing
+        '''
         
         _vars = bpy.types.TMB_RENDER_OT_variables
+        _kwargs = {} if _vars.pending == 'FINAL' else {
+            'use_viewport' : self.use_viewport
+        }
+        #-------------- set before the job starts, it may complete right away
         _vars.rendering_subframe = True
-        bpy.ops.render.render(
+        _result = bpy.ops.render.render(
+            self.context_override(),
             'INVOKE_DEFAULT',
             animation = False,
             write_still = False,
-            use_viewport = self.use_viewport
+            **_kwargs
         )
+        if 'CANCELLED' in _result:
+            _vars.rendering_subframe = False
+            return 0.01
+        _vars.pending = None
+        return self.step_poll
+    
+    def render_step(self):
+        '''
+        One step of the render state machine, run by bpy.app.timers
+        in the main thread. It is registered once by execute() and
+        polls flags set by render_complete handlers every step_poll
+        seconds, so the next subframe is started right after
+        the previous one is completed
+        '''
         
-    def open_images(self, path):
-        '''Open all subframe images files as images in Blender'''
+        _vars = bpy.types.TMB_RENDER_OT_variables
+        if _vars.finished:
+            return None
+        #--------------------- retry render, if the last one wasn't started:
+        if _vars.pending:
+            return self.render_subframe()
+        #------------------------------------ wait for the render to complete
+        if _vars.rendering_subframe:
+            return self.step_poll
+        #------ add just completed subframe to the running-sum buffers first:
+        if _vars.subframe_completed:
+            _vars.subframe_completed = False
+            self.accumulate_subframe()
+        #------------------------ if final subframe (frame) render is completed
+        if _vars.final_completed:
+            _vars.final_completed = False
+            self.save_frame_restore()
+            self.resume_frame_done()
+            self.rendering_frame = False
+        #---------------------------------------- if frame is not rendering:
+        if not self.rendering_frame:
+            self.frames_skip()
+            #---------- if there are no more frames to render wake modal() up
+            #---------------------------------- to finish in the UI context:
+            if not self.frames:
+                self.resume_end()
+                _vars.finished = True
+                self.timer_add()
+                return None
+            #--------------------- otherwise reset TMB images and set frame:
+            self.reset_images()
+            self.reset_buffers()
+            self.set_frame()
+            self.resume_frame()
+            self.carry_frame()
+            self.cache_frame()
+            self.rendering_frame = True
+        #--------------- if there's only one subframe (which is frame) left
+        #------ mix subframes to images, prepare saving and render mixed frame:
+        if len(self.render['conc_subframes']) == 1:
+            self.mix_buffers()
+            self.save_frame_prepare()
+            _vars.pending = 'FINAL'
+            return self.render_subframe()
+        #-------------- setup subframe and render layers and start render:
+        self.set_subframe()
+        self.set_rlayers()
+        _vars.pending = 'SUBFRAME'
+        return self.render_subframe()
+        
+    def subframe_files(self, path):
+        '''Return list of all subframe images files in path'''
         
         _fpath = pathlib.Path(path)
-        images = []
+        files = []
         for child in _fpath.glob('*'):
             if child.is_file():
-                img = bpy.data.images.load(str(child))
-                images.append(img)
+                files.append(str(child))
             else:
-                images += self.open_images(str(child))
-        return images
+                files += self.subframe_files(str(child))
+        return files
+    
+    def capture_to_buffer(self, npass, weight = 1, keep = False):
+        '''
+        Add TMB Viewer pixels weight times to the pass running-sum buffer.
+        keep: save them for the next frame too
+        '''
+        
+        _viewer = bpy.data.images.get('Viewer Node')
+        if not _viewer or self.pixels_len(_viewer) != npass.array.size:
+            self.capture_warning(_viewer, npass)
+            return
+        _buffer = npass.buffer
+        _buffer.weights[npass.row] += weight
+        if self.mixer:
+            _pixels = self.pixels_read(
+                _viewer, out = self.mixer.staging[_buffer.key]
+            )
+            self.capture_save(_viewer, _pixels, keep)
+            self.mixer.add_block(_buffer.key, npass.row, weight)
+            return
+        _pixels = self.pixels_buffer(npass.array.size, name = 'capture')
+        self.capture_save(
+            _viewer, self.pixels_read(_viewer, out = _pixels), keep
+        )
+        if weight != 1:
+            _pixels *= weight
+        npass.array += _pixels
     
-    def buffers_to_image(self, path, img, samples):
-        '''Open subframe images, mix them to frame image and delete them'''
+    def capture_warning(self, viewer, npass):
+        '''
+        Warn once per render that the TMB Viewer pixels can't be added:
+        the pass gets no subframes and its image stays black
+        '''
         
-        _sub_images = self.open_images(path)
-        _sub_arrays = np.zeros(
-            (len(_sub_images), self.project['pix_len']),
-            dtype = 'f'
+        _vars = bpy.types.TMB_RENDER_OT_variables
+        if _vars.capture_warned:
+            return
+        _vars.capture_warned = True
+        _size = (
+            f'{viewer.size[0]}x{viewer.size[1]}x{viewer.channels}'
+            if viewer else 'no image'
         )
-        for num in range(len(_sub_images)):
-            _sub_arrays[num][:] = np.array(_sub_images[num].pixels[:])[:]
-        _result = _sub_arrays.sum(axis=0)
-        _divided = np.divide(_result[:], samples)
-        img.pixels[:] = _divided[:]
-        for img in _sub_images:
-            bpy.data.images.remove(img)
-    
-    def delete_images(self, fpath):
-        '''Delete all files in file path'''
-        
-        _fpath = pathlib.Path(fpath)
-        for child in _fpath.glob('*'):
-            if child.is_file():
-                child.unlink()
+        _msg = f'TMB Capture: Viewer image ({_size}) doesn\'t match render\
+ resolution ({self.project["pix_len"]} values), "{npass.npass.name}" pass\
+ isn\'t mixed. Set Capture to Files for this render'
+        try:
+            if bpy.app.background:
+                bpy.ops.tmb.warning('INVOKE_DEFAULT', type='WARNING', msg=_msg)
             else:
-                self.delete_images(child)
+                bpy.ops.tmb.warning(
+                    self.context_override(), 'INVOKE_DEFAULT',
+                    type='WARNING', msg=_msg
+                )
+        except (RuntimeError, KeyError): #------ no window to show the popup
+            self.report({'WARNING'}, _msg)
     
-    def mix_buffers(self):
-        '''Mix rendered subframes files to Blender images'''
-        _scenes = self.rlayers
-        for sc in list(_scenes.keys()):
-            if (
-                self.scenes[sc]['engine'] == 'CYCLES' or
-                not self.scenes[sc]['tmb'] or
-                not self.scenes[sc]['tmb']['activate']
-            ):
+    def capture_path(self, subframe):
+        '''Return folder of saved TMB Viewer capture of the subframe'''
+        
+        return pathlib.os.path.join(
+            self.restore['main_dir'], '_capture', str(subframe)
+        )
+    
+    def capture_keep(self):
+        '''Save TMB Viewer pixels rendered for the next frame only'''
+        
+        _viewer = bpy.data.images.get('Viewer Node')
+        if not _viewer:
+            return
+        _pixels = self.pixels_buffer(self.pixels_len(_viewer), name='capture')
+        self.capture_save(
+            _viewer, self.pixels_read(_viewer, out = _pixels), True
+        )
+    
+    def capture_save(self, viewer, pixels, keep = False):
+        '''
+        Save captured subframe pixels with the project storage backend,
+        so the subframe can be reused on resume, by the next frame
+        or by the next renders through the subframes cache
+        '''
+        
+        if not self.manifest and not keep and not self.cache:
+            return
+        _path = self.capture_path(self.render['subframe'])
+        pathlib.Path(_path).mkdir(parents=True, exist_ok=True)
+        _w, _h = viewer.size
+        _rgba = pixels.reshape(_h, _w, 4)[::-1]
+        self.storage_save(
+            pathlib.os.path.join(_path, 'capture'),
+            {'R' : _rgba[..., 0], 'G' : _rgba[..., 1], 'B' : _rgba[..., 2]},
+            self.project['storage'],
+            self.project['half']
+        )
+    
+    def accumulate_subframe(self, resumed = False):
+        '''
+        Add just rendered subframe of every unmuted TMB pass
+        to its running-sum buffer and delete the subframe files.
+        Files are decoded in background by the threads pool or mixer process.
+        Passes sharing one multilayer file are added from one decoding
+        in a single operation on their Render Layer buffer.
+        With Resume files are kept until the frame is saved
+        and resumed subframes are read from disk, captures too.
+        Files of Render Layers kept for the next frame are not deleted
+        '''
+        
+        _step = self.plan_step
+        for _layer, _weight in zip(_step.layers, _step.weights):
+            _keep = _layer in _step.keep
+            _groups = [
+                (_step.folder(_path), _rows, _layers)
+                for _path, _rows, _layers in _layer.groups
+            ]
+            for npass in _layer.captures:
+                if not resumed:
+                    self.capture_to_buffer(npass, _weight, _keep)
+                    continue
+                _groups.append((
+                    self.capture_path(_step.subframe),
+                    [npass.row], [npass.layer]
+                ))
+            if not resumed: #---------- before the files are deleted by mixing
+                self.cache_add(_layer, _step)
+            for _path, _rows, _layers in _groups:
+                self.accumulate_files(
+                    _layer.buffer, _path, _rows, _layers, _weight, not _keep
+                )
+        #---------------------- Render Layers rendered for the next frame only
+        for _layer in _step.keep:
+            if _layer in _step.layers or resumed:
+                continue
+            if _layer.captures:
+                self.capture_keep()
+            self.cache_add(_layer, _step)
+        if self.manifest and not resumed:
+            self.manifest.subframe_done(self.render['subframe'])
+    
+    def accumulate_files(
+        self, buffer, path, rows, layers, weight = 1, delete = True
+    ):
+        '''
+        Add subframe files in path to the buffer rows, one EXR layer per row,
+        weight times (for subframes of several snapped ones).
+        Files are decoded in background by the threads pool or mixer process
+        and deleted then, unless delete is False or Resume keeps them
+        '''
+        
+        _delete = delete and not self.manifest
+        for fpath in self.subframe_files(path):
+            buffer.weights[rows] += weight
+            if self.mixer:
+                self.mixer.add_file(
+                    fpath, [(buffer.key, rows, layers)], _delete, weight
+                )
+                continue
+            self.pool_add(
+                fpath, [(buffer.key, buffer.array, rows, layers)],
+                _delete, weight
+            )
+    
+    def subframes_paths(self):
+        '''Return folders of TMB passes and captures subframes folders'''
+        
+        _paths = {pathlib.os.path.join(self.restore['main_dir'], '_capture')}
+        for sc in list(self.rlayers.keys()):
+            _rlayers = self.rlayers[sc]['rlayers']
+            for rl in list(_rlayers.keys()):
+                for npass in list(_rlayers[rl].keys()):
+                    if _rlayers[rl][npass].get('path'):
+                        _paths.add(_rlayers[rl][npass]['path'])
+        return _paths
+    
+    def subframes_remove(self, keep = ()):
+        '''
+        Remove all subframes folders of TMB passes and captures
+        except ones of keep subframes
+        '''
+        
+        _keep = {str(_subframe) for _subframe in keep}
+        for _path in self.subframes_paths():
+            for child in pathlib.Path(_path).glob('*'):
+                if child.name in _keep:
+                    continue
+                if child.is_file():
+                    child.unlink()
+                else:
+                    shutil.rmtree(child, ignore_errors = True)
+    
+    def carry_frame(self):
+        '''
+        Add subframes rendered and kept with the previous frame
+        from disk instead of rendering them again
+        '''
+        
+        _conc = self.render['conc_subframes']
+        for _subframe in self.render['carried']:
+            #----------------- the last one is for final mixing, resumed too
+            if _subframe not in _conc[:-1]:
                 continue
-            _rlayers = _scenes[sc]['rlayers']
+            _conc.remove(_subframe)
+            self.render['subframe'] = _subframe
+            self.set_rlayers()
+            self.accumulate_subframe(resumed = True)
+            if self.manifest:
+                self.manifest.subframe_done(_subframe)
+    
+    def carry_remove(self):
+        '''Remove kept subframes folders if the next frame wasn't rendered'''
+        
+        _carry = self.render['carry']
+        if not _carry:
+            return
+        self.render['carry'] = None
+        for _path in self.subframes_paths():
+            for _subframe in _carry['subframes']:
+                shutil.rmtree(
+                    pathlib.os.path.join(_path, str(_subframe)),
+                    ignore_errors = True
+                )
+    
+    def resume_settings(self):
+        '''
+        Return settings which subframes on disk depend on,
+        progress saved with other settings is not resumed
+        '''
+        
+        _passes = []
+        for sc in list(self.rlayers.keys()):
+            _rlayers = self.rlayers[sc]['rlayers']
             for rl in list(_rlayers.keys()):
                 for npass in list(_rlayers[rl].keys()):
-                    _path = _rlayers[rl][npass]['path']
-                    _image = _rlayers[rl][npass]['image']
-                    _samples = self.scenes[rl.scene]['tmb']['samples']
-                    self.buffers_to_image(_path, _image, _samples)
-                    self.delete_images(_path)
+                    _passes.append(f'{sc.name}|{rl.layer}|{npass.name}')
+        return {
+            "file" : bpy.data.filepath,
+            "scene" : self.sc.name,
+            "pix_len" : self.project['pix_len'],
+            "tmb" : {
+                sc.name : [
+                    sc.true_mb.position, sc.true_mb.shutter,
+                    sc.true_mb.samples, sc.true_mb.boost
+                ] for sc in list(self.scenes.keys()) if sc.true_mb.activate
+            },
+            "passes" : sorted(_passes),
+            "capture" : self.project['capture'],
+            "multilayer" : self.project['multilayer'],
+            "storage" : self.project['storage'],
+            "half" : self.project['half'],
+            "snap" : self.project['snap'],
+        }
+    
+    def resume_start(self):
+        '''
+        With Resume load progress of interrupted animation render
+        and skip its finished frames. Otherwise start a new progress
+        manifest and remove subframes left by another render
+        '''
+        
+        self.manifest = None
+        if not self.project['resume']:
+            return
+        self.manifest = TMB_Manifest(
+            self.restore['main_dir'], self.resume_settings()
+        )
+        self.restore['resume'] = True
+        if self.manifest.load():
+            _done = self.manifest.frames_done()
+            self.frames[:] = [fr for fr in self.frames if fr not in _done]
+            return
+        self.subframes_remove()
+        self.manifest.save()
+    
+    def resume_frame(self):
+        '''
+        Save the frame as started. If it was interrupted add its
+        subframes completed before and don't render them again
+        '''
+        
+        if not self.manifest:
+            return
+        self.manifest.frame_start(self.frame)
+        _conc = self.render['conc_subframes']
+        for _subframe in self.manifest.subframes_done(self.frame):
+            #------------------------------ the last one is for final mixing
+            if _subframe not in _conc[:-1]:
+                continue
+            _conc.remove(_subframe)
+            self.render['subframe'] = _subframe
+            self.set_rlayers()
+            self.accumulate_subframe(resumed = True)
+            #------ files of the next frame could be rendered by another plan
+            if self.render['carry']:
+                _kept = self.render['carry']['subframes']
+                if _subframe in _kept:
+                    _kept.remove(_subframe)
+    
+    def resume_frame_done(self):
+        '''Save the frame as finished and remove its subframes'''
+        
+        if not self.manifest:
+            return
+        self.manifest.frame_done(self.frame)
+        _carry = self.render['carry']
+        self.subframes_remove(keep = _carry['subframes'] if _carry else ())
+    
+    def resume_end(self):
+        '''All frames are rendered: temporary data is not needed anymore'''
+        
+        if not self.manifest:
+            return
+        self.manifest.remove()
+        self.restore['resume'] = False
+    
+    def cache_start(self):
+        '''
+        Open the subframes cache if it is enabled
+        and hash the scenes state for its keys
+        '''
+        
+        if not self.project['cache']:
+            return
+        self.cache = TMB_Cache(
+            self.project['cache_dir'], self.project['cache'] * 1024 * 1024
+        )
+        self.cache.evict()
+        self.cache_scenes = {
+            sc : self.cache_scene(sc) for sc in list(self.rlayers.keys())
+        }
+    
+    def cache_scene(self, sc):
+        '''
+        Return hash of the scenes data generation (TMB_SceneState)
+        and render settings of the scene and its View Layers,
+        with the structs they own such as Workbench shading
+        '''
+        
+        _settings = [
+            sc.camera.name if sc.camera else '',
+            sc.world.name if sc.world else '',
+        ]
+        for _struct in (sc.render, getattr(sc, 'eevee', None), sc.display):
+            _settings.append(TMB_Cache.rna_values(_struct))
+        for _vl in sc.view_layers:
+            _settings.append(TMB_Cache.rna_values(_vl))
+            _collections = [_vl.layer_collection]
+            while _collections:
+                _lc = _collections.pop()
+                _settings.append((
+                    _lc.name, _lc.exclude, _lc.holdout,
+                    _lc.indirect_only, _lc.hide_viewport
+                ))
+                _collections.extend(_lc.children)
+        return TMB_Cache.key(
+            TMB_SceneState.token, TMB_SceneState.generation, sc.name, _settings
+        )
+    
+    def cache_groups(self, layer, step):
+        '''
+        Return (subframe folder, cache key, buffer rows, EXR layers, capture)
+        of every files group of the Render Layer subframe
+        '''
+        
+        _scene = self.cache_scenes[layer.scene]
+        _settings = [
+            self.project[key]
+            for key in ('pix_len', 'storage', 'half', 'multilayer')
+        ]
+        _groups = []
+        for _path, _rows, _layers in layer.groups:
+            _names = [layer.passes[row].npass.name for row in _rows]
+            _groups.append((
+                step.folder(_path),
+                TMB_Cache.key(
+                    _scene, _settings, layer.rlayer.layer,
+                    _names, _layers, step.subframe
+                ),
+                _rows, _layers, False
+            ))
+        for npass in layer.captures:
+            _groups.append((
+                self.capture_path(step.subframe),
+                TMB_Cache.key(
+                    _scene, _settings, layer.rlayer.layer,
+                    [npass.npass.name], 'capture', step.subframe
+                ),
+                [npass.row], [npass.layer], True
+            ))
+        return _groups
+    
+    def cache_add(self, layer, step):
+        '''
+        Add just rendered subframe files of the Render Layer to the cache.
+        Captures which are not needed anymore are moved there
+        '''
+        
+        if not self.cache:
+            return
+        _move = not self.manifest and layer not in step.keep
+        for _path, _key, _rows, _layers, _capture in self.cache_groups(
+            layer, step
+        ):
+            self.cache.add(
+                _key, self.subframe_files(_path), move = _move and _capture
+            )
+    
+    def cache_find(self, step):
+        '''
+        Return [(TMB_Layer, weight, [(cache folder, rows, EXR layers)])]
+        of the subframe if all its files are cached, otherwise None
+        '''
+        
+        _found = []
+        for _layer, _weight in zip(step.layers, step.weights):
+            _folders = []
+            for _path, _key, _rows, _layers, _capture in self.cache_groups(
+                _layer, step
+            ):
+                _folder = self.cache.get(_key)
+                if _folder is None:
+                    return None
+                _folders.append((_folder, _rows, _layers))
+            _found.append((_layer, _weight, _folders))
+        return _found
+    
+    def cache_frame(self):
+        '''
+        Add subframes found in the subframes cache from it instead
+        of rendering them. If all subframes of the frame are cached
+        it goes straight to mixing and the final Compositor render
+        '''
+        
+        if not self.cache:
+            return
+        _conc = self.render['conc_subframes']
+        for _subframe in _conc[:-1]:
+            _found = self.cache_find(self.render['plan'][_subframe])
+            if _found is None:
+                continue
+            _conc.remove(_subframe)
+            for _layer, _weight, _folders in _found:
+                for _path, _rows, _layers in _folders:
+                    self.accumulate_files(
+                        _layer.buffer, _path, _rows, _layers, _weight, False
+                    )
+            #----------------- the next frame finds the subframe in the cache
+            _carry = self.render['carry']
+            if _carry and _subframe in _carry['subframes']:
+                _carry['subframes'].remove(_subframe)
+        #--------- found folders are just marked as used, so they're kept:
+        self.cache.evict()
+    
+    def buffers_to_image(self, npass):
+        '''Assign normalized pass buffer to its image'''
+        
+        if not npass.mixed():
+            return
+        self.pixels_write(npass.image, npass.array)
+    
+    def mix_buffers(self):
+        '''Normalize accumulated subframes buffers to Blender images'''
+        _layers = [_layer for _layer in self.render['layers'] if _layer.buffer]
+        _buffers = [_layer.buffer for _layer in _layers]
+        #---------- mixer process returns already normalized shared buffers
+        if self.mixer:
+            _weights = self.mixer.finish()
+            for _buffer in _buffers:
+                _buffer.weights[:] = _weights[_buffer.key]
+        else:
+            self.pool_wait()
+            self.pool_divide(
+                [_buffer.array for _buffer in _buffers],
+                [_buffer.weights for _buffer in _buffers]
+            )
+        for _layer in _layers:
+            for npass in _layer.passes:
+                self.buffers_to_image(npass)
         
     def img_to_path(self):
         '''Move images from temp. File Output folder to scene render folder'''
@@ -584,6 +1389,8 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         #--------------------------------------------- mute all TMB File Outputs
         for fo in self.restore['tmb_f_outs']:
             fo.mute = True
+        if self.restore['capture']:
+            self.restore['capture'].mute = True
         #-------- relink all TMB images directly to TMB mix nodes children-links 
         if self.restore['mix_nodes']:
             for node in self.restore['mix_nodes']:
@@ -595,17 +1402,20 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
             for fo in self.restore['file_outputs']:
                 fo.mute = False
         #------------------------------- change render_copmlete handler function
+        #------------------ (background render loop runs without handlers)
         while self.handler_complete in bpy.app.handlers.render_complete:
             bpy.app.handlers.render_complete.remove(self.handler_complete)
-        bpy.app.handlers.render_complete.append(self.handler_final)
+        if not bpy.app.background:
+            bpy.app.handlers.render_complete.append(self.handler_final)
         #----------------------------------------- set current frame as subframe 
         _frame = self.render['conc_subframes'].pop(0)
         self.sc.frame_set(_frame, subframe = 0.0)
-        #--------------------------- if render animation unmute main File Output
-        if self.animation:
+        #---------- if render animation or in background unmute main File Output
+        if self.animation or bpy.app.background:
             self.project['output'].mute = False
         #------------------------------------------- update preview just in case
-        bpy.ops.tmb.update('INVOKE_DEFAULT')
+        if not bpy.app.background:
+            bpy.ops.tmb.update(self.context_override(), 'INVOKE_DEFAULT')
         
     def save_frame_restore(self):
         '''Restore project from frame saving'''
@@ -631,15 +1441,21 @@ class TMB_RenderHelpers(TMB_RenderVariables, bpy.types.Operator):
         #-------------------------------------------- umute all TMB File Outputs
         for fo in self.restore['tmb_f_outs']:
             fo.mute = False
+        #------------------ unmute TMB capture Viewer and make it active again
+        if self.restore['capture']:
+            self.restore['capture'].mute = False
+            self.sc.node_tree.nodes.active = self.restore['capture']
         #------------------------------- change render_copmlete handler function
         while self.handler_final in bpy.app.handlers.render_complete:
             bpy.app.handlers.render_complete.remove(self.handler_final)
-        bpy.app.handlers.render_complete.append(self.handler_complete)
+        if not bpy.app.background:
+            bpy.app.handlers.render_complete.append(self.handler_complete)
         #---------------- move rendered image file from main File Outputs folder
         #--------------------------------- to render folder (for animation only)
         self.img_to_path()
-        #------------------------------------------- update preview just in case
-        bpy.ops.tmb.update('INVOKE_DEFAULT')
+        #------------- update preview just in case (TMB capture Viewer does it)
+        if not self.restore['capture'] and not bpy.app.background:
+            bpy.ops.tmb.update(self.context_override(), 'INVOKE_DEFAULT')
     
     def instant(self, context):
         '''Check cases when it is possible to start native render instantly'''
@@ -713,6 +1529,18 @@ class TMB_Render(TMB_RenderHelpers, bpy.types.Operator):
         description="Scene",
         default="",
         )
+    claim : BoolProperty(
+        name="Claim Frames",
+        description="Background render only: render just the frames claimed\
+ through lock files in the render folder, shared with other renders",
+        default=False,
+        )
+    run : StringProperty(
+        name="Claim Run",
+        description="Background render only: id of the renders sharing\
+ claimed frames, frames marked done by other runs follow Overwrite",
+        default="",
+        )
 
     def __init__(self):
         self.t1 = perf_counter()
@@ -725,19 +1553,36 @@ class TMB_Render(TMB_RenderHelpers, bpy.types.Operator):
             bpy.app.handlers.render_pre.remove(self.handler_pre)
         while self.handler_final in bpy.app.handlers.render_complete:
             bpy.app.handlers.render_complete.remove(self.handler_final)
+        self.step_remove()
+        _vars = bpy.types.TMB_RENDER_OT_variables
+        _idle = (_vars.idle_time, _vars.idle_count)
+        _vars.idle_time = 0.0
+        _vars.idle_count = 0
         #--------------------------------------- reset TMB_Render Operator class
         self.cleanup()
-        #------------------------------------ make report with total render time
+        #-------------- make report with total render time and idle time
+        #------------------------------------------ between renders
         self.t2 = perf_counter()
         try:
             _total_time = str(datetime.timedelta(seconds=(self.t2-self.t1)))
             _msg = f'Total Render Time: {_total_time[:-3]}'
+            if _idle[1]:
+                _msg += (
+                    f'\nIdle Between Renders: {_idle[0]:.3f} s,'
+                    f' {_idle[0] / _idle[1] * 1000:.1f} ms average'
+                )
             bpy.ops.tmb.warning('INVOKE_DEFAULT', type = "INFO", msg = _msg)
         except:
             pass
                 
     def execute(self, context):
         sc = context.scene
+        if self.instant(context) and self.claim:
+            _msg = f'Scene "{sc.name}" has no True Motion Blur:\
+ frames can\'t be claimed. Render it without --claim'
+            bpy.ops.tmb.warning('INVOKE_DEFAULT', type = 'ERROR', msg=_msg)
+            self.cleanup()
+            return {'CANCELLED'}
         if self.instant(context):
             self.instant_prepare(context)
             self.render_native()
@@ -775,82 +1620,93 @@ class TMB_Render(TMB_RenderHelpers, bpy.types.Operator):
             bpy.ops.tmb.warning('INVOKE_DEFAULT', type = 'ERROR', msg=_msg)
             return {'FINISHED'}
         self.get_frames()
+        self.buffers_add()
+        self.resume_start()
+        self.cache_start()
+        if bpy.app.background:
+            return self.render_background()
         bpy.app.handlers.render_complete.append(self.handler_complete)
         bpy.app.handlers.render_pre.append(self.handler_pre)
-        self.timer_add()
+        self.step_add()
         self.project['wm'].modal_handler_add(self)
         return {"RUNNING_MODAL"}
     
+    def render_background(self):
+        '''
+        Synchronous render loop for background mode (blender -b):
+        the same steps as render_step with blocking renders
+        and no window, timers, handlers or modal.
+        With claim frames are taken one by one through lock files,
+        so several renders of the same file share the frame range
+        '''
+        
+        _locks = None
+        if self.claim:
+            _locks = TMB_FrameLocks(
+                self.project['render_path'], self.project['base_name'],
+                run = self.run
+            )
+            #----------------- tmb_farm.py removes done markers after the run
+            _temp = bpy.context.preferences.filepaths.temporary_directory
+            if self.run and _temp:
+                _locks.save(bpy.path.abspath(_temp))
+        while self.frames:
+            if _locks:
+                _frame = _locks.claim_next(self.frames)
+                if _frame is None:
+                    break
+                self.frames.remove(_frame)
+                self.frames.insert(0, _frame)
+            if not self.frame_check(self.frames[0]):
+                _frame = self.frames.pop(0)
+                if _locks:
+                    _locks.done(_frame)
+                continue
+            self.reset_images()
+            self.reset_buffers()
+            self.set_frame()
+            self.resume_frame()
+            self.carry_frame()
+            self.cache_frame()
+            while len(self.render['conc_subframes']) > 1:
+                self.set_subframe()
+                self.set_rlayers()
+                bpy.ops.render.render(
+                    animation = False,
+                    write_still = False,
+                    use_viewport = self.use_viewport
+                )
+                self.accumulate_subframe()
+            self.mix_buffers()
+            self.save_frame_prepare()
+            bpy.ops.render.render(animation = False, write_still = False)
+            self.save_frame_restore()
+            self.resume_frame_done()
+            if _locks:
+                _locks.done(self.frame)
+        if not self.frames:
+            self.resume_end()
+        self.finalize()
+        return {'FINISHED'}
+    
     def modal(self, context, event):
+        '''
+        Render steps are run by bpy.app.timers (see render_step),
+        modal only catches abort and finishes in the UI context
+        '''
         
+        _vars = bpy.types.TMB_RENDER_OT_variables
         #------------------------------------------- if aborted by pressing ESC:
         if event.type == 'ESC':
+            self.step_remove()
             self.timer_remove()
             self.finalize()
             return {'CANCELLED'}
-        #-------------------------------------------------- on each Timer event:
-        elif event.type == 'TIMER':
-            self.timer_remove() #---------------------------------- remove Timer
-            _vars = bpy.types.TMB_RENDER_OT_variables
-            
-            #---- if subframe rendering haven't started after the first command:
-            if _vars.rendering_subframe:
-                if not _vars.started:
-                    self.render_subframe()
-            
-            #---------------------------------------- if frame is not rendering:
-            elif not self.rendering_frame:
-                #------------------------ if there are no more frames to render:
-                if not self.frames:
-                    self.finalize()
-                    return {'FINISHED'}
-                #--------------------- otherwise reset TMB images, set frame and
-                #------------------------ command to start rendering algorithms:
-                else:
-                    self.reset_images()
-                    self.set_frame()
-                    self.rendering_frame = True
-            
-            #--------------- if there's only one subframe (which is frame) left:
-            elif len(self.render['conc_subframes']) == 1:
-                #----------------- check if subframe rendering status is active:
-                if not _vars.rendering_subframe:
-                    _vars.rendering_subframe = True
-                #---------------------- mix subframes to images, prepare saving,
-                #--------------------------------------- and render mixed frame:
-                self.mix_buffers()                
-                self.save_frame_prepare()
-                bpy.ops.render.render(
-                    'INVOKE_DEFAULT',
-                    animation = False,
-                    write_still = False)
-            
-            #------- if render haven't started after previous command, force it:
-            elif (
-                not self.render['conc_subframes'] and
-                not _vars.final_completed and
-                not _vars.started
-            ):
-                self.render_subframe()
-            
-            #--------------------- if final subframe (frame) render is completed
-            #----------------------------- set all command statuses as inactive:
-            elif (
-                not self.render['conc_subframes'] and
-                _vars.final_completed
-            ):
-                _vars.final_completed = False
-                self.save_frame_restore()                
-                _vars.rendering_subframe = False
-                self.rendering_frame = False
-            #----------------- if subframe rendering is inactive, make it active
-            #---------------- setup subframe and render layers and start render:
-            elif not _vars.rendering_subframe:
-                _vars.rendering_subframe = True
-                self.set_subframe()
-                self.set_rlayers()
-                self.render_subframe()
-            self.timer_add()#------------------------------------ add Timer back
+        #---------------------------- when render_step has rendered all frames
+        elif event.type == 'TIMER' and _vars.finished:
+            self.timer_remove()
+            self.finalize()
+            return {'FINISHED'}
         return {'PASS_THROUGH'}
     
     def invoke(self, context, event):
@@ -0,0 +1,103 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+#  True Motion Blur add-on
+#  TMB render progress manifest
+#  (c) 2020 Andrey Sokolov (so_records)
+
+#  Module doesn't import bpy: render settings are passed in as plain data
+
+import os, json
+
+class TMB_Manifest():
+    '''
+    Progress of animation render saved next to the temporary subframes:
+    completed frames and completed subframes of the current frame.
+    Saved after every subframe and frame through a temporary file
+    and os.replace, so a crash never leaves it half written
+    '''
+
+    name = 'tmb_resume.json'
+
+    def __init__(self, path, settings):
+        self.path = os.path.join(path, self.name)
+        #----------------------------- compare with loaded data as JSON does
+        self.settings = json.loads(json.dumps(settings))
+        self.data = {
+            "settings" : self.settings,
+            "frames" : [],
+            "frame" : None,
+            "subframes" : [],
+        }
+
+    def load(self):
+        '''
+        Load saved progress if it was made with the same settings.
+        Return True if loaded
+        '''
+
+        try:
+            with open(self.path) as fh:
+                _data = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        if _data.get('settings') != self.settings:
+            return False
+        self.data = _data
+        return True
+
+    def save(self):
+        _tmp = f'{self.path}.tmp'
+        with open(_tmp, 'w') as fh:
+            json.dump(self.data, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(_tmp, self.path)
+
+    def remove(self):
+        for _path in (self.path, f'{self.path}.tmp'):
+            try:
+                os.remove(_path)
+            except FileNotFoundError:
+                pass
+
+    def frames_done(self):
+        return list(self.data['frames'])
+
+    def subframes_done(self, frame):
+        '''Return completed subframes of the frame'''
+
+        if self.data['frame'] != frame:
+            return []
+        return list(self.data['subframes'])
+
+    def frame_start(self, frame):
+        if self.data['frame'] != frame:
+            self.data['frame'] = frame
+            self.data['subframes'] = []
+            self.save()
+
+    def subframe_done(self, subframe):
+        self.data['subframes'].append(subframe)
+        self.save()
+
+    def frame_done(self, frame):
+        self.data['frames'].append(frame)
+        self.data['frame'] = None
+        self.data['subframes'] = []
+        self.save()
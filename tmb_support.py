@@ -20,10 +20,13 @@
 #  TMB render support operators
 #  (c) 2020 Andrey Sokolov (so_records)
 
-import bpy, pathlib, shutil
+import bpy, os, json, socket, hashlib, pathlib, shutil
 import numpy as np
 from bpy.utils import register_class, unregister_class
 from bpy.props import BoolProperty, StringProperty, EnumProperty, IntProperty
+from .tmb_buffers import STORAGE
+from .tmb_farm import pid_alive
+from .tmb_resume import TMB_Manifest
 
 #------------------------------ Warning Operator -------------------------------
 
@@ -47,9 +50,63 @@ class TMB_Warning(bpy.types.Operator):
         return {'FINISHED'}
         
     def invoke(self, context, event):
+        if bpy.app.background: #------------------ no window to report to
+            print(f'True Motion Blur {self.type}: {self.msg}')
+            return {'FINISHED'}
         context.window_manager.modal_handler_add(self)
         return {'RUNNING_MODAL'}
 
+#--------------------------------- Scene State ---------------------------------
+
+class TMB_SceneState():
+    '''
+    Scenes data generation for the subframes cache keys.
+    Changed by every depsgraph update except Compositor only ones:
+    compositing node trees, scenes (their render settings are hashed
+    by the render itself) and TMB images. New token for every opened file
+    '''
+    
+    token = os.urandom(8).hex()
+    generation = 0
+
+@bpy.app.handlers.persistent
+def scene_updated(scene, depsgraph = None):
+    '''depsgraph_update_post, undo_post and redo_post handler function'''
+    
+    _updates = depsgraph.updates if depsgraph else [None]
+    for upd in _updates:
+        _id = upd.id.original if upd else None
+        if (
+            isinstance(_id, bpy.types.Scene) or
+            isinstance(_id, bpy.types.NodeTree) and _id.type == 'COMPOSITING' or
+            isinstance(_id, bpy.types.Image) and (
+                _id.type in {'RENDER_RESULT', 'COMPOSITING'} or
+                _id.name.startswith('TMB_') or
+                _id.name == 'Viewer Node'
+            )
+        ):
+            continue
+        TMB_SceneState.generation += 1
+        return
+
+@bpy.app.handlers.persistent
+def scene_loaded(*args):
+    '''load_post handler function'''
+    
+    TMB_SceneState.token = os.urandom(8).hex()
+    TMB_SceneState.generation = 0
+
+def scene_handlers():
+    '''Return handler lists and TMB_SceneState handler functions'''
+    
+    _handlers = bpy.app.handlers
+    return [
+        (_handlers.depsgraph_update_post, scene_updated),
+        (_handlers.undo_post, scene_updated),
+        (_handlers.redo_post, scene_updated),
+        (_handlers.load_post, scene_loaded),
+    ]
+
 ############################## MAIN PROJECT STORAGE ############################
 
 class TMB_Store(bpy.types.Operator):
@@ -66,6 +123,7 @@ class TMB_Store(bpy.types.Operator):
             "render_path": project Render Output path
             "path" : directory path for creating temporary folders to save subframes
                     and animation render results to,
+                    render session folder in it after TMB_SaveBuffers,
             "format" : file format,
             "rlayers" : [ list of Render Layers nodes ],
             "composite" : composite output
@@ -77,6 +135,19 @@ class TMB_Store(bpy.types.Operator):
             "pix_len" : int number of pixels per frame,
             "single" : True if main_sc.render.use_single_layer,
             "render_passes" : true_mb.render_passes,
+            "capture" : true_mb.capture,
+            "mixer" : true_mb.mixer,
+            "threads" : true_mb.threads,
+            "multilayer" : true_mb.multilayer,
+            "storage" : true_mb.storage,
+            "half" : true_mb.half,
+            "resume" : true_mb.resume for animation render,
+            "keep_nodes" : true_mb.keep_nodes,
+            "snap" : true_mb.snap,
+            "cache" : true_mb.cache, subframes cache size in MB,
+            "cache_dir" : subframes cache folder in the temporary directory,
+            "fingerprint" : Compositor and settings hash (TMB_Scaffold),
+            "reuse" : True if kept TMB nodes are reused,
             "has_f_outs" : True if compositor has active file outputs
             "links" : [ all active used Render Layers outputs ]
             "image_settings" : {
@@ -130,22 +201,47 @@ class TMB_Store(bpy.types.Operator):
                                 "image" : pass image
                                 "img_node" : pass image node,
                                 "mix_node" : pass mix node,
-                                "array" : ndarray for all subframes pixels
+                                "buffer" : Render Layer buffer (see "buffers")
+                                "row" : pass row in the buffer "array"
+                                "array" : the row, running sum of subframes
                                 "file_output" : save buffer file output node
                                 "path" : temporary save buffers directory
+                                "layer" : pass layer name in multilayer EXR
+                                "capture" : True if pass is read from Viewer
                             },
                             Pass2 : {...},
                             .....},                        
                     Rlayer2 : {...{...},{...},{...}},
                 .....},
+                "buffers" : {
+                    RLayer1 : TMB_Buffer (tmb_model.py) {
+                        key : name for mixer and threads pool,
+                        array : float32 (passes, pixels) running sums,
+                        weights : number of subframes in each row,
+                    },
+                .....},
                 "subframes" : [ list of subframes for current frame ]
+                "weights" : { subframe : number of scene subframes snapped to it }
             Scene 2 : {...{...},{...},{...}},
         .....},
+        "Graph": { #--------------------main scene Compositor index, TMB_RLayers
+            "sinks" : { node : { Composite and File Output nodes it leads to } },
+            "sources" : { node : { Render Layers passes leading to it } },
+        },
         "Render": { #--------------------------------------Temporary render data
             "images" : [ tmb_images ],
             "frames" : [ frames to render ],
             "frame" : context frame,
             "conc_subframes" : [concatenated subframes from all scenes],
+            "layers" : [ TMB_Layer of every Render Layer (tmb_model.py) ],
+            "plan" : { subframe : TMB_Step of the frame (tmb_model.py) },
+            "carry" : { #----------- subframes shared with the next frame or None
+                "frame" : next frame,
+                "ticks" : { scene : { tick : weight } } of the next frame,
+                "settings" : { scene : TMB settings in the next frame },
+                "subframes" : [ rendered subframes kept for the next frame ]
+            },
+            "carried" : [ subframes of the frame kept by the previous one ],
             "subframe" : context subframe,
             "rlayers" : [ not muted rlayers for current subframe ],
             "scene" : current rlayer scene,
@@ -167,6 +263,9 @@ class TMB_Store(bpy.types.Operator):
             "area" : { area : type }
             "file_outputs" : [ list of user file outputs ]
             "tmb_f_outs" : [ list of tmb file outputs ]
+            "capture" : TMB Viewer node for in memory subframes capture
+            "session" : render session folder in the temporary directory
+            "resume" : keep main_dir to resume interrupted render
             "viewers" : {
                 V1.name : {
                     "center_x" : node.center_x,
@@ -225,6 +324,7 @@ class TMB_Store(bpy.types.Operator):
         op.store["Project"] = {}
         op.store["RLayers"] = {}
         op.store["Scenes"] = {}
+        op.store["Graph"] = {}
         op.store["Render"] = {}
         _render = op.store["Render"]
         _render["images"] = []
@@ -232,6 +332,10 @@ class TMB_Store(bpy.types.Operator):
         _render["frame"] = None
         _render["rlayers"] = []
         _render["conc_subframes"] = []
+        _render["layers"] = []
+        _render["plan"] = {}
+        _render["carry"] = None
+        _render["carried"] = []
         _render["subframe"] = None
         _render["file_output"] = None
         op.store["Restore"] = {}
@@ -239,9 +343,12 @@ class TMB_Store(bpy.types.Operator):
         _restore["muted"] = []
         _restore["file_outputs"] = []
         _restore["tmb_f_outs"] = []
+        _restore["capture"] = None
         _restore["viewers"] = {}
         _restore["tmb_nodes"] = []
         _restore["main_dir"] = None
+        _restore["session"] = None
+        _restore["resume"] = False
         _restore["mix_nodes"] = []
         _restore["folders"] = []
         _restore["area"] = {}
@@ -419,6 +526,20 @@ class TMB_Store(bpy.types.Operator):
         _prj["pix_len"] = self.get_pixels_len()
         _prj["single"] = context.scene.render.use_single_layer
         _prj["render_passes"]= self.get_render_passes()
+        _prj["capture"] = self.scene.true_mb.capture
+        _prj["mixer"] = self.scene.true_mb.mixer
+        _prj["threads"] = self.scene.true_mb.threads
+        _prj["multilayer"] = self.scene.true_mb.multilayer
+        #------------------------- .blend files saved with NPY storage read ''
+        _prj["storage"] = self.scene.true_mb.storage or 'EXR'
+        _prj["half"] = self.scene.true_mb.half
+        _prj["resume"] = self.scene.true_mb.resume and self.animation
+        _prj["keep_nodes"] = self.scene.true_mb.keep_nodes
+        _prj["snap"] = self.scene.true_mb.snap
+        _prj["cache"] = self.scene.true_mb.cache
+        _prj["cache_dir"] = None
+        _prj["fingerprint"] = None
+        _prj["reuse"] = False
         _prj["has_f_outs"] = False
         _prj["links"] = []
         _imgsets = _prj["main_sc"].render.image_settings
@@ -484,6 +605,64 @@ class TMB_Store(bpy.types.Operator):
 
 class TMB_Helpers():
     '''Helper methods for multiple scenes render without TMB render passes'''
+    
+    def graph_index(self):
+        '''
+        Index the main scene Compositor in one pass and store it
+        into the main storage. Every node is visited once, results
+        of nodes shared by several branches are reused
+        '''
+        
+        _sinks = {}
+        _sources = {}
+        
+        def sinks(node):
+            if node in _sinks:
+                return _sinks[node]
+            _found = _sinks[node] = {} #-------- set first to stop on link loops
+            if node.type in {'COMPOSITE', 'OUTPUT_FILE'}:
+                _found[node] = True
+            for out in node.outputs:
+                for lnk in out.links:
+                    _found.update(sinks(lnk.to_node))
+            return _found
+        
+        def input_sources(input):
+            if not input.links:
+                return {}
+            _from = input.links[0].from_node
+            if _from.type == 'R_LAYERS':
+                return {} if _from.mute else {input.links[0].from_socket : True}
+            return sources(_from)
+        
+        def sources(node):
+            if node in _sources:
+                return _sources[node]
+            _found = _sources[node] = {}
+            for input in node.inputs:
+                _found.update(input_sources(input))
+            return _found
+        
+        for node in self.project['main_sc'].node_tree.nodes:
+            sinks(node)
+            sources(node)
+        self.store['Graph'] = {
+            "sinks" : _sinks,
+            "sources" : _sources,
+        }
+    
+    def rl_sources(self, input):
+        '''
+        Return active Render Layers' passes the input's links lead to,
+        in the order of inputs
+        '''
+        
+        if not input.links:
+            return []
+        _from = input.links[0].from_node
+        if _from.type == 'R_LAYERS':
+            return [] if _from.mute else [input.links[0].from_socket]
+        return list(self.store['Graph']['sources'].get(_from, {}).keys())
         
     def npass_used(self, npass, node_type = 'COMPOSITE'):
         '''
@@ -492,27 +671,26 @@ class TMB_Helpers():
         Return True or False
         '''
         
-        if not len(npass.links):
-            return False
-        else:
-            for lnk in npass.links:
-                _child = lnk.to_node
-                _used = False
-                if _child.type == 'COMPOSITE' and not _child.mute:
+        _sinks = self.store['Graph']['sinks']
+        for lnk in npass.links:
+            for node in _sinks.get(lnk.to_node, {}):
+                if node.type == 'COMPOSITE' and not node.mute:
                     return True
                 elif (
-                    _child.type == node_type == 'OUTPUT_FILE' and
-                    _child in list(self.restore['file_outputs'].keys())
+                    node.type == node_type == 'OUTPUT_FILE' and
+                    node in self.restore['file_outputs']
                 ):
                     return True
-                # there's no need to check if outputs don't exist at all
-                # because in this case they are represented as an empty list,
-                # not None
-                for out in _child.outputs:
-                    _used = self.npass_used(out, node_type=node_type)
-                    if not _used:
-                        continue
-                    return _used
+        return False
+    
+    def link_new(self, from_socket, to_socket):
+        '''
+        Link sockets unless reused TMB nodes already have the input linked
+        '''
+        
+        if self.project['reuse'] and to_socket.links:
+            return
+        self.project['main_sc'].node_tree.links.new(from_socket, to_socket)
     
     def clear_path(self, fpath):
         '''Remove directory and all its content'''
@@ -525,6 +703,135 @@ class TMB_Helpers():
                 self.clear_path(child)
         _fpath.rmdir()
     
+#------------------------- Check TMB nodes kept to reuse -----------------------
+
+class TMB_Scaffold(TMB_Helpers, bpy.types.Operator):
+    '''
+    With Keep Nodes TMB File Outputs, Mix and Image nodes are kept muted
+    after render. Reuse them if the Compositor graph and render settings
+    fingerprint didn't change since, remove kept File Outputs otherwise
+    '''
+    
+    bl_idname = 'tmb.scaffold'
+    bl_label = 'Check Kept Nodes'
+    store = None
+    project = None
+    restore = None
+    scene = None
+    prop = 'tmb_scaffold'
+    
+    def structure(self):
+        '''Sync to the main storage'''
+        
+        self.store = bpy.types.TMB_OT_store.store
+        self.project = self.store['Project']
+        self.restore = self.store['Restore']
+        self.scene = self.project['main_sc']
+    
+    def kept(self):
+        '''Return names of TMB File Outputs kept by the previous render'''
+        
+        _stored = self.scene.node_tree.get(self.prop)
+        return set(_stored['nodes']) if _stored else set()
+    
+    def is_tmb(self, node, kept):
+        '''Return True for TMB nodes and Viewers, not part of the user graph'''
+        
+        return (
+            node.name in kept or
+            node.type == 'VIEWER' or
+            node.type == 'ALPHAOVER' and node.name.startswith('TMB_Mix') or
+            node.type == 'IMAGE' and node.name.startswith('TMB_Image')
+        )
+    
+    def user_socket(self, socket, kept):
+        '''
+        Return output socket as if there were no TMB nodes:
+        Render Layers pass instead of TMB Mix output, None for other TMB nodes
+        '''
+        
+        _node = socket.node
+        if _node.type == 'ALPHAOVER' and _node.name.startswith('TMB_Mix'):
+            _links = _node.inputs[1].links
+            return _links[0].from_socket if _links else None
+        if self.is_tmb(_node, kept):
+            return None
+        return socket
+    
+    def fingerprint(self, kept):
+        '''
+        Hash user Compositor nodes and links, ignoring TMB nodes,
+        and render settings which TMB nodes depend on
+        '''
+        
+        _tree = self.scene.node_tree
+        _nodes = []
+        for node in _tree.nodes:
+            if self.is_tmb(node, kept):
+                continue
+            _rl = node.type == 'R_LAYERS'
+            _nodes.append((
+                node.name, node.bl_idname, node.mute,
+                node.scene.name if _rl and node.scene else '',
+                node.layer if _rl else '',
+                [out.enabled for out in node.outputs],
+            ))
+        _links = []
+        for lnk in _tree.links:
+            if self.is_tmb(lnk.to_node, kept):
+                continue
+            _from = self.user_socket(lnk.from_socket, kept)
+            if _from is None:
+                continue
+            _links.append((
+                _from.node.name, _from.identifier,
+                lnk.to_node.name, lnk.to_socket.identifier,
+            ))
+        _scenes = [
+            (
+                sc.name, sc.render.engine, sc.true_mb.activate,
+                [vl.use for vl in sc.view_layers]
+            ) for sc in self.project['scenes']
+        ]
+        _settings = [
+            self.project[key] for key in (
+                'pix_len', 'single', 'render_passes', 'capture',
+                'multilayer', 'storage', 'half'
+            )
+        ]
+        _data = repr((
+            sorted(_nodes), sorted(_links), _scenes, _settings,
+            sorted(self.project['image_settings'].items())
+        ))
+        return hashlib.sha1(_data.encode()).hexdigest()
+    
+    def remove_kept(self, kept):
+        '''Remove kept TMB File Outputs and forget them'''
+        
+        _tree = self.scene.node_tree
+        for name in kept:
+            if name in _tree.nodes:
+                _tree.nodes.remove(_tree.nodes[name])
+        if self.prop in _tree:
+            del _tree[self.prop]
+    
+    def execute(self, context):
+        self.structure()
+        if not self.scene.node_tree:
+            return {'FINISHED'}
+        _kept = self.kept()
+        _stored = self.scene.node_tree.get(self.prop)
+        self.project['fingerprint'] = self.fingerprint(_kept)
+        self.project['reuse'] = bool(
+            self.project['keep_nodes'] and
+            _stored and
+            _stored['fingerprint'] == self.project['fingerprint'] and
+            all(name in self.scene.node_tree.nodes for name in _kept)
+        )
+        if not self.project['reuse']:
+            self.remove_kept(_kept)
+        return {'FINISHED'}
+    
 #-------------------------------- Get Rlayers ----------------------------------  
   
 class TMB_RLayers(TMB_Helpers, bpy.types.Operator):
@@ -614,12 +921,13 @@ class TMB_RLayers(TMB_Helpers, bpy.types.Operator):
     
     def execute(self, context):
         self.structure()
+        self.graph_index()
         self.rlayers()
         return {'FINISHED'}
     
 #----------------- Mute user File Outputs and delete Viewers -------------------
 
-class TMB_UserOutputs(bpy.types.Operator):
+class TMB_UserOutputs(TMB_Helpers, bpy.types.Operator):
     '''Mute file outputs and remove viewers'''
     
     bl_idname = "tmb.userouts"
@@ -656,34 +964,25 @@ class TMB_UserOutputs(bpy.types.Operator):
         return _links
     
     def links_from_rl(self, input):
-        '''Append to "self.rl_links" any links to Render Layer nodes' outputs'''
+        '''
+        Add to RLayers all Render Layer nodes' outputs the input leads to.
+        Return True if any
+        '''
         
-        if not input.links:
-            return False
-        elif (
-            input.links[0].from_node.type == 'R_LAYERS' and
-            not input.links[0].from_node.mute
-        ):
-            _rl = input.links[0].from_node
-            _rl_dict = self.rlayers[_rl.scene]['rlayers'][_rl]
-            _rl_dict[input.links[0].from_socket] = {}
-            return True
-        elif not input.links[0].from_node.inputs:
-            return False
-        else:
-            for i in input.links[0].from_node.inputs:
-                if self.links_from_rl(i):
-                    return True
-            return False
+        _outs = self.rl_sources(input)
+        for out in _outs:
+            _rl_dict = self.rlayers[out.node.scene]['rlayers'][out.node]
+            _rl_dict.setdefault(out, {})
+        return bool(_outs)
     
     def get_rl_links(self, node):
         if not node.inputs or not self.has_links(node):
             return False
-        for num in range(len(node.inputs)):
-            input = node.inputs[num]            
+        _links = False
+        for input in node.inputs:
             if self.links_from_rl(input):
-                return True
-        return False
+                _links = True
+        return _links
         
     def outputs(self):
         '''
@@ -772,19 +1071,7 @@ class TMB_Links(TMB_Helpers, bpy.types.Operator):
         Append pass to self.rl_links if found
         '''
         
-        if not input.links:
-            return
-        elif (
-            input.links[0].from_node.type == 'R_LAYERS' and
-            not input.links[0].from_node.mute
-        ):
-            self.rl_links.append(input.links[0].from_socket)
-        elif not input.links[0].from_node.inputs:
-            return
-        else:
-            for i in input.links[0].from_node.inputs:
-                self.get_connected_rl_outs(i)
-            return
+        self.rl_links.extend(self.rl_sources(input))
     
     def get_all_links(self):
         '''
@@ -886,22 +1173,111 @@ class TMB_SaveBuffers(TMB_Helpers, bpy.types.Operator):
             self.restore['tmb_f_outs'].append(_fo)
         return _fo
     
+    def session_owner(self, session):
+        '''Return {"host", "pid"} of the render session folder or None'''
+        
+        try:
+            with open(pathlib.os.path.join(session, 'tmb_session.json')) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+    
+    def session_manifest(self, session):
+        '''Return path of session resume manifest'''
+        
+        return pathlib.os.path.join(
+            session, '_True_Motion_Blur_tmp', TMB_Manifest.name
+        )
+    
+    def sessions_stale(self, temp_dir):
+        '''
+        Return folders of TMB render sessions of this machine
+        whose Blender processes are not running anymore
+        '''
+        
+        _host = socket.gethostname()
+        _stale = []
+        for _session in pathlib.Path(temp_dir).glob('_TMB_Session_*'):
+            _owner = self.session_owner(_session)
+            if (
+                _owner and
+                _owner['host'] == _host and
+                _owner['pid'] != os.getpid() and
+                not pid_alive(_owner['pid'])
+            ):
+                _stale.append(_session)
+        return _stale
+    
+    def session_resumable(self, session):
+        '''Return True if the session has progress of this file and scene'''
+        
+        try:
+            with open(self.session_manifest(session)) as fh:
+                _settings = json.load(fh)['settings']
+        except (OSError, ValueError, KeyError):
+            return False
+        return (
+            _settings.get('file') == bpy.data.filepath and
+            _settings.get('scene') == self.scene.name
+        )
+    
+    def add_session_dir(self, temp_dir):
+        '''
+        Create folder of this render session in the temporary directory,
+        unique for the machine and Blender process, so several renders
+        don't touch each other's files. Remove folders of finished
+        sessions of dead processes, keep only those which can be resumed.
+        With Resume adopt the session interrupted by a crash
+        '''
+        
+        _session = pathlib.os.path.join(
+            temp_dir, f'_TMB_Session_{socket.gethostname()}_{os.getpid()}'
+        )
+        for _stale in self.sessions_stale(temp_dir):
+            if not pathlib.os.path.isfile(self.session_manifest(_stale)):
+                shutil.rmtree(_stale, ignore_errors = True)
+            elif (
+                self.project['resume'] and
+                not pathlib.os.path.exists(
+                    self.session_manifest(_session)
+                ) and
+                self.session_resumable(_stale)
+            ):
+                shutil.rmtree(_session, ignore_errors = True)
+                try: #-------------- another render may have adopted it first
+                    os.rename(_stale, _session)
+                except OSError:
+                    pass
+        pathlib.Path(_session).mkdir(parents=True, exist_ok=True)
+        with open(pathlib.os.path.join(_session, 'tmb_session.json'), 'w') as fh:
+            json.dump({"host" : socket.gethostname(), "pid" : os.getpid()}, fh)
+        self.restore["session"] = _session
+        return _session
+    
     def add_main_dir(self):
         '''
-        Create main temporary directory in the project render folder.
-        Store it into the main storage
+        Create main temporary directory in the render session folder.
+        The session folder becomes the project temporary path.
+        Store them into the main storage
         '''
         
-        _proj_dir = self.project['path']
+        _temp_dir = self.project['path']
         if (
-            not pathlib.os.path.exists(_proj_dir) or
-            pathlib.os.path.isfile(_proj_dir)
+            not pathlib.os.path.exists(_temp_dir) or
+            pathlib.os.path.isfile(_temp_dir)
         ):
-            _proj_dir = pathlib.Path(str(_proj_dir))
-            _proj_dir = str(_proj_dir.parents[0])
+            _temp_dir = pathlib.Path(str(_temp_dir))
+            _temp_dir = str(_temp_dir.parents[0])
+        _proj_dir = self.add_session_dir(_temp_dir)
+        self.project['cache_dir'] = pathlib.os.path.join(
+            _temp_dir, '_TMB_Cache'
+        )
+        self.project['path'] = _proj_dir
         _tmb_dir = pathlib.os.path.join(_proj_dir, "_True_Motion_Blur_tmp")
         _main_out = pathlib.os.path.join(_proj_dir, '_TMB_Output')
-        if pathlib.os.path.exists(_tmb_dir):
+        #------------- subframes of interrupted render are checked and reused
+        #--------------------------------------- or removed by TMB_Render
+        if pathlib.os.path.exists(_tmb_dir) and not self.project['resume']:
             self.clear_path(_tmb_dir)
         if  pathlib.os.path.exists(_main_out):
             self.clear_path(_main_out)
@@ -922,34 +1298,100 @@ class TMB_SaveBuffers(TMB_Helpers, bpy.types.Operator):
         self.restore['folders'].append(fo_path)
         return fo_path
     
+    def capture_add(self, lnk):
+        '''Create, setup and link TMB Viewer for in memory subframes capture'''
+        
+        sc = self.scene
+        _viewer = sc.node_tree.nodes.new('CompositorNodeViewer')
+        _viewer.name = 'TMB_Capture'
+        _viewer.use_alpha = False
+        _viewer.location.x = lnk.node.location.x + 300
+        _viewer.location.y = lnk.node.location.y + 300
+        _viewer.hide = True
+        sc.node_tree.links.new(lnk, _viewer.inputs[0])
+        sc.node_tree.nodes.active = _viewer
+        self.restore['tmb_nodes'].append(_viewer)
+        self.restore['capture'] = _viewer
+        
+        _sets = self.rlayers[lnk.node.scene]['rlayers'][lnk.node][lnk]
+        _sets["file_output"] = None
+        _sets["path"] = None
+        _sets["layer"] = ''
+        _sets["capture"] = True
+    
+    def get_layers_fo(self, rl, layers_fos):
+        '''
+        Create/use existing TMB multilayer File Output for all passes
+        of the Render Layer. Clear its layer slots on the first call
+        '''
+        
+        if rl in layers_fos:
+            return layers_fos[rl]
+        _fo = self.get_fo(f'{rl.scene.name}_{rl.layer}')
+        if not self.project['reuse']:
+            _fo.layer_slots.clear()
+        _fo.base_path = self.get_path(rl.scene.name, rl.layer, 'layers')
+        _fo.format.file_format = "OPEN_EXR_MULTILAYER"
+        _fo.format.color_mode = "RGB"
+        _fo.format.color_depth = "16" if self.project["half"] else "32"
+        _fo.format.exr_codec = STORAGE[self.project["storage"]].codec
+        _fo.location.x = rl.location.x + 300
+        _fo.location.y = rl.location.y + 300 - (22 * len(layers_fos))
+        _fo.hide = True
+        layers_fos[rl] = _fo
+        return _fo
+    
     def save_buffers_add(self):
-        '''Create, setup and link File Outputs for each active render pass'''
+        '''
+        Create, setup and link File Outputs for each active render pass
+        or one multilayer File Output per Render Layer with pass per layer
+        '''
     
         sc = self.scene
         _links = sc.node_tree.links
         _f_outs = self.restore['file_outputs']
+        _layers_fos = {}
         y_loc = 0
         for lnk in self.links:
+            if (
+                self.project['capture'] == 'MEMORY' and
+                not self.restore['capture']
+            ):
+                self.capture_add(lnk)
+                continue
             y_loc += 1
             _rl = lnk.node
             _num = [
                 out for out in range(len(_rl.outputs))
                 if _rl.outputs[out] == lnk
                 ][0]
+            _sets = self.rlayers[_rl.scene]['rlayers'][_rl][_rl.outputs[_num]]
+            if self.project['multilayer']:
+                _fo = self.get_layers_fo(_rl, _layers_fos)
+                _layer = f'{_num:02d}'
+                if not (self.project['reuse'] and _layer in _fo.inputs):
+                    _links.new(lnk, _fo.layer_slots.new(name = _layer))
+                _sets["file_output"] = _fo
+                _sets["path"] = _fo.base_path
+                _sets["layer"] = _layer
+                _sets["capture"] = False
+                continue
             _fo_name = f'{_rl.scene.name}_{_rl.layer}_{_num:02d}'
             _fo = self.get_fo(_fo_name)
             _fo.base_path = self.get_path(_rl.scene.name, _rl.layer, _num)
             _fo.format.file_format = "OPEN_EXR"
             _fo.format.color_mode = "RGB"
-            _fo.format.color_depth = "32"
+            _fo.format.color_depth = "16" if self.project["half"] else "32"
+            _fo.format.exr_codec = STORAGE[self.project["storage"]].codec
             _fo.location.x = _rl.location.x + 300
             _fo.location.y = _rl.location.y + 300 - (22 * y_loc)
             _fo.hide = True
-            _links.new(lnk,_fo.inputs[0])
+            self.link_new(lnk,_fo.inputs[0])
             
-            _sets = self.rlayers[_rl.scene]['rlayers'][_rl][_rl.outputs[_num]]
             _sets["file_output"] = _fo
             _sets["path"] = _fo.base_path
+            _sets["layer"] = ''
+            _sets["capture"] = False
                 
     def output_fo_add(self):
         '''Add main File Output which will act as a render result writer'''
@@ -1000,9 +1442,11 @@ class TMB_SaveBuffers(TMB_Helpers, bpy.types.Operator):
             return
         
         _to_mix = self.project['composite'].inputs[0].links[0].from_socket
-        self.scene.node_tree.links.new(_to_mix, _fo.inputs[0])
+        self.link_new(_to_mix, _fo.inputs[0])
         if _imgsets['file_format'] == 'OPEN_EXR_MULTILAYER':
             for lnk in self.links:
+                if self.project['reuse'] and lnk.name in _fo.inputs:
+                    continue
                 _new_in = _fo.layer_slots.new(name = lnk.name)
                 self.scene.node_tree.links.new(lnk, _new_in)
         _fo.mute = True
@@ -1179,24 +1623,52 @@ class TMB_AddMixImages(TMB_Helpers, bpy.types.Operator):
         name = f'{base_name}_{rl.scene.name}_{rl.layer}_{npass.name}'
         return name
         
-    def add_passes_mix_imgs(self):
+    def can_reuse(self):
+        '''
+        Return True if Mix and Image nodes of all passes are kept
+        from the previous render and can be reused
+        '''
+        
+        nodes = self.scene.node_tree.nodes
+        return self.project['reuse'] and all(
+            self.get_name('mix', lnk.node, lnk) in nodes and
+            self.get_name('img', lnk.node, lnk) in nodes
+            for lnk in self.links
+        )
+    
+    def reuse_mix_img(self, lnk):
+        '''Return kept Image and Mix nodes of the pass reset for render'''
+        
+        nodes = self.scene.node_tree.nodes
+        m_node = nodes[self.get_name('mix', lnk.node, lnk)]
+        i_node = nodes[self.get_name('img', lnk.node, lnk)]
+        m_node.inputs[0].default_value = 0
+        i_node.image = self.set_image(i_node.name)
+        return i_node, m_node
+    
+    def add_passes_mix_imgs(self, reuse = False):
         '''
         Add image and mix nodes for each individual pass of each active
         Render layers node in the main scene Compositor
+        or reuse kept ones
         '''
         
         _links = self.project['main_sc'].node_tree.links
         y_loc = 0
         for lnk in self.links:
             y_loc += 1
-            nodes = self.add_mix_img()
-            m_node = self.set_mix_node(nodes[1], lnk.node, lnk, y_loc)                
-            i_name = self.get_name('img', lnk.node, lnk)
-            i_image = self.set_image(i_name)
-            i_node = self.set_img_node(nodes[0], i_image, m_node)
-            i_node.label = m_node.label = lnk.name
-            _links.new(lnk, m_node.inputs[1])
-            _links.new(i_node.outputs[0], m_node.inputs[2])
+            if reuse:
+                i_node, m_node = self.reuse_mix_img(lnk)
+                i_image = i_node.image
+            else:
+                nodes = self.add_mix_img()
+                m_node = self.set_mix_node(nodes[1], lnk.node, lnk, y_loc)
+                i_name = self.get_name('img', lnk.node, lnk)
+                i_image = self.set_image(i_name)
+                i_node = self.set_img_node(nodes[0], i_image, m_node)
+                i_node.label = m_node.label = lnk.name
+                _links.new(lnk, m_node.inputs[1])
+                _links.new(i_node.outputs[0], m_node.inputs[2])
             _passes = self.rlayers[lnk.node.scene]['rlayers'][lnk.node]
             _passes[lnk]['image'] = i_image
             _passes[lnk]['img_node'] = i_node
@@ -1206,8 +1678,10 @@ class TMB_AddMixImages(TMB_Helpers, bpy.types.Operator):
                 
     def execute(self, context):
         self.structure()
-        self.remove_existing()
-        self.add_passes_mix_imgs()
+        _reuse = self.can_reuse()
+        if not _reuse:
+            self.remove_existing()
+        self.add_passes_mix_imgs(reuse = _reuse)
         return {'FINISHED'}
     
 #-------------------------------- Scenes Setup ---------------------------------     
@@ -1337,6 +1811,7 @@ class TMB_Setup(bpy.types.Operator):
         _tmb = sc.true_mb
         bpy.ops.tmb.store(animation = self.animation)
         self.project = bpy.types.TMB_OT_store.store['Project']
+        bpy.ops.tmb.scaffold()
         bpy.ops.tmb.rlayers()
         if not [
             rl for rl in self.project['rlayers']
@@ -1348,7 +1823,8 @@ class TMB_Setup(bpy.types.Operator):
         bpy.ops.tmb.savebuffers()
         bpy.ops.tmb.miximgs()
         bpy.ops.tmb.scsetup()
-        bpy.ops.tmb.backdrop('INVOKE_DEFAULT')
+        if not bpy.app.background:
+            bpy.ops.tmb.backdrop('INVOKE_DEFAULT')
         return {'FINISHED'}
     
 ############################### RESTORE OPERATOR ###############################
@@ -1431,7 +1907,8 @@ class TMB_Restore(TMB_Helpers, bpy.types.Operator):
         Set all TMB Mix (Alpha Over) nodes mix factor to 1
         Unmute temporary muted nodes
         Remove temporary TMB supporting nodes
-            except TMB Render Layers and Composite nodes
+            except TMB Render Layers and Composite nodes,
+            mute TMB File Outputs instead with Keep Nodes
         Recreate and relink the Viewer        
         '''
         
@@ -1445,9 +1922,16 @@ class TMB_Restore(TMB_Helpers, bpy.types.Operator):
         if self.restore['muted']:
             for node in self.restore['muted']:
                 node.mute = False
+        _kept = []
         if self.restore['tmb_nodes']:
             for node in self.restore['tmb_nodes']:
-                if node.type not in ('R_LAYERS', 'COMPOSITE'):
+                if (
+                    node.type == 'OUTPUT_FILE' and
+                    self.project['keep_nodes']
+                ):
+                    node.mute = True
+                    _kept.append(node.name)
+                elif node.type not in ('R_LAYERS', 'COMPOSITE'):
                     sc.node_tree.nodes.remove(node)
                 elif node.type == 'COMPOSITE':
                     comps = [
@@ -1464,12 +1948,28 @@ class TMB_Restore(TMB_Helpers, bpy.types.Operator):
                                     )
                                     sc.node_tree.nodes.remove(node)
                                     break
+        self.keep_nodes(_kept)
         if self.restore['viewers']:
             for viewer in list(self.restore['viewers'].keys()):
                 self.restore_viewer(self.restore['viewers'][viewer])
         for rl in self.project['rlayers']:
             rl.mute = False
         
+    def keep_nodes(self, kept):
+        '''
+        Save names of kept TMB File Outputs and the fingerprint
+        of the setup they belong to into the Compositor node tree
+        '''
+        
+        _tree = self.scene.node_tree
+        if self.project['keep_nodes'] and self.project['fingerprint']:
+            _tree[TMB_Scaffold.prop] = {
+                "fingerprint" : self.project['fingerprint'],
+                "nodes" : kept,
+            }
+        elif TMB_Scaffold.prop in _tree:
+            del _tree[TMB_Scaffold.prop]
+    
     def remove_out_dir(self):
         '''Remove temporary main out folder from disc'''
         
@@ -1481,13 +1981,18 @@ class TMB_Restore(TMB_Helpers, bpy.types.Operator):
         self.clear_path(_spath)
     
     def cleanup(self):
-        '''Remove temporary subframes folders from disc'''
+        '''
+        Remove temporary subframes folders from disc,
+        unless they are kept to resume interrupted render
+        '''
         
+        if self.restore['resume']:
+            return
         if (
-            self.restore['main_dir'] and
-            pathlib.os.path.isdir(self.restore["main_dir"])
+            self.restore['session'] and
+            pathlib.os.path.isdir(self.restore["session"])
         ):
-            self.clear_path(self.restore["main_dir"])
+            self.clear_path(self.restore["session"])
     
     def execute(self, context):
         self.structure()
@@ -1502,6 +2007,7 @@ class TMB_Restore(TMB_Helpers, bpy.types.Operator):
 classes = [
     TMB_Warning,
     TMB_Store,
+    TMB_Scaffold,
     TMB_RLayers,
     TMB_Links,
     TMB_SaveBuffers,
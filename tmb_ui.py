@@ -46,6 +46,8 @@ class TMB_Keyconfig(bpy.types.Operator):
     
     def execute(self, context):
         configs = context.window_manager.keyconfigs
+        if bpy.app.background or not configs.active: #-------- no keymaps
+            return {'CANCELLED'}
         items = configs.active.keymaps['Screen'].keymap_items
         keymap = [i for i in items if i.idname == "render.render"]
         keymap_tmb = [i for i in items if i.idname == "render.render"]
@@ -126,6 +128,93 @@ class TMB_TrueMB(bpy.types.PropertyGroup):
         max=1,
         subtype = "FACTOR"
     )
+    capture : EnumProperty(
+        name = "Capture",
+        description = "How subframes render results are passed to the mixing",
+        items = [
+            ("FILES", "Files",
+                "Save subframes of all passes to temporary EXR files"),
+            ("MEMORY", "Memory",
+                "Read one pass per subframe from a Viewer node in memory,\
+ other passes are saved to temporary EXR files"),
+        ],
+        default="FILES"
+    )
+    storage : EnumProperty(
+        name = "Storage",
+        description = "How subframes are stored on disk between render\
+ and mixing",
+        #------------- numbers keep values saved before NPY item was removed
+        items = [
+            ("EXR", "EXR",
+                "Uncompressed EXR files, memory-mapped for mixing", 0),
+            ("ZLIB", "Compressed",
+                "zlib compressed files: smaller and slower to encode,\
+ for slow disks", 2),
+        ],
+        default="EXR"
+    )
+    half : BoolProperty(
+        name="Half Float Subframes",
+        description="Store subframes as 16 bit half float: half the disk\
+ traffic and memory, subframes are still summed in 32 bit float.\
+\nRelative error of the result is below 0.05%, values above 65504\
+ can't be stored",
+        default=False
+    )
+    resume : BoolProperty(
+        name="Resume",
+        description="Continue interrupted animation render: skip frames\
+ finished before and reuse rendered subframes of the interrupted frame",
+        default=False
+    )
+    snap : FloatProperty(
+        name="Snap Subframes",
+        description="Share subframes between TMB scenes with different\
+ settings: subframes closer than this (in frames) to subframes of the scene\
+ with most samples are rendered at their time and weighted.\
+ 0 renders every scene's own subframes",
+        default=0,
+        min=0,
+        soft_max=0.1,
+        step=0.1,
+        precision=4
+    )
+    cache : IntProperty(
+        name="Subframes Cache",
+        description="Disk space in MB for subframes kept between renders:\
+ if only the Compositor has changed, cached subframes are mixed without\
+ rendering them again. 0 disables the cache",
+        default=0,
+        min=0,
+        soft_max=100000
+    )
+    keep_nodes : BoolProperty(
+        name="Keep Nodes",
+        description="Keep TMB nodes muted after render and reuse them\
+ while the Compositor and render settings don't change",
+        default=False
+    )
+    mixer : BoolProperty(
+        name="Mixer Process",
+        description="Decode and sum subframes in a separate helper process\
+ while the next subframe is rendering",
+        default=False
+    )
+    threads : IntProperty(
+        name="Mix Threads",
+        description="Number of threads decoding and summing subframes,\
+ 0 for all CPU cores",
+        default=0,
+        min=0,
+        max=256
+    )
+    multilayer : BoolProperty(
+        name="Multilayer Subframes",
+        description="Save all passes of a render layer to one multilayer EXR\
+ file per subframe instead of one file per pass",
+        default=False
+    )
     render_passes : BoolProperty(
         name="Render Passes",
         description="Render all enabled render passes, even if they are \
@@ -173,6 +262,16 @@ class TMB_PT_true_mb_panel(TMB_Panel, bpy.types.Panel):
         col.separator()        
         col.prop(props, "samples")
         col.prop(props, "boost")
+        col.prop(props, "snap")
+        col.prop(props, "capture")
+        col.prop(props, "multilayer")
+        col.prop(props, "storage")
+        col.prop(props, "half")
+        col.prop(props, "resume")
+        col.prop(props, "keep_nodes")
+        col.prop(props, "cache")
+        col.prop(props, "mixer")
+        col.prop(props, "threads")
         col.prop(props, "render_passes")
 
 #-------------------------- Replace native Top Menu ----------------------------